@@ -1,16 +1,319 @@
 import pandas as pd
+import numpy as np
 import sys
 import os
 import re
 import urllib.parse
 import argparse
+import ipaddress
+import random
+import heapq
+import math
+import hashlib
+import itertools
+import tempfile
+import json
+import logging
+import base64
+import bisect
+import time
+import shutil
+import socket
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from collections import namedtuple, deque
 
-# 设置工作目录为EXE文件所在目录
-if getattr(sys, 'frozen', False):
-    os.chdir(os.path.dirname(sys.executable))
-else:
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+def set_working_directory():
+    """设置工作目录为EXE文件（或脚本）所在目录；只在作为程序运行时调用，作为库导入时不改变工作目录"""
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+# 读取和提取过程的进度信息通过 logger 输出：作为库使用时由调用方配置 logging（默认不输出）；
+# 作为程序运行时 main 安装 ConsoleLogHandler，与其他提示一样直接输出
+logger = logging.getLogger("ip_tool")
+
+class ConsoleLogHandler(logging.Handler):
+    """按原文输出日志到当前的 sys.stdout（-o - 时 sys.stdout 已改为标准错误）"""
+    
+    def emit(self, record):
+        print(self.format(record))
+
+def setup_console_logging():
+    """作为程序运行时将进度信息输出到控制台"""
+    if not any(isinstance(handler, ConsoleLogHandler) for handler in logger.handlers):
+        logger.addHandler(ConsoleLogHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# IP匹配规则：IPv4 前后不能紧接数字或点（排除 1.2.3.4.5 之类的片段），八位组范围由 normalize_ip 校验；
+# IPv6 候选需再经 ipaddress 校验（排除时间、MAC等误匹配）；不带方括号的候选至少含一个十六进制数字，
+# 文本中用作分隔符的 " :: " 不会被当作未指定地址 ::
+IPV4_PATTERN = r'(?<![\d.])\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(?!\.?\d)'
+IPV4_OCTETS_RE = re.compile(r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$')
+IPV6_PATTERN = r'(?:[0-9A-Fa-f]{0,4}:){2,7}(?:\d+\.\d+\.\d+\.\d+|[0-9A-Fa-f]{0,4})(?:%[\w.\-]+)?'
+IPV4_RE = re.compile(r'(' + IPV4_PATTERN + r')')
+IPV4_FULL_RE = re.compile(r'^' + IPV4_PATTERN + r'$')
+IPV4_PORT_RE = re.compile(r'(' + IPV4_PATTERN + r'):(\d+)')
+IPV4_COMMA_PORT_RE = re.compile(r'(' + IPV4_PATTERN + r')\s*,\s*(\d+)')
+IPV6_RE = re.compile(r'(?<![\w:.%])((?=:*[0-9A-Fa-f])' + IPV6_PATTERN + r')(?![\w:])')
+IPV6_BRACKET_PORT_RE = re.compile(r'\[(' + IPV6_PATTERN + r')\]:(\d+)')
+IPV6_COMMA_PORT_RE = re.compile(r'^\]?\s*,\s*(\d+)')
+
+def normalize_ip(value):
+    """规范化IP地址：IPv6 转为标准压缩小写形式（保留区域ID），非IP返回None"""
+    text = str(value).strip()
+    if text.startswith('[') and text.endswith(']'):
+        text = text[1:-1]
+    if ':' in text:
+        addr, _, zone = text.partition('%')
+        try:
+            address = ipaddress.IPv6Address(addr)
+        except ValueError:
+            return None
+        # IPv4映射地址保留点分写法
+        canonical = f"::ffff:{address.ipv4_mapped}" if address.ipv4_mapped else str(address)
+        return f"{canonical}%{zone}" if zone else canonical
+    return canonical_ipv4(text)
+
+def canonical_ipv4(text):
+    """IPv4 按整数解析八位组，超出 0-255 返回None；去掉前导零（001.002.003.004 → 1.2.3.4）"""
+    # 已是标准写法的地址（绝大多数）由 inet_pton/inet_ntoa 直接确认，不再逐个八位组解析
+    try:
+        if socket.inet_ntoa(socket.inet_pton(socket.AF_INET, text)) == text:
+            return text
+    except (OSError, ValueError):
+        pass
+    match = IPV4_OCTETS_RE.match(text)
+    if not match:
+        return None
+    octets = [int(octet) for octet in match.groups()]
+    if max(octets) > 255:
+        return None
+    return '.'.join(map(str, octets))
+
+def canonical_port(value):
+    """端口按整数解析，范围 1-65535，返回规范文本；空值或非法返回None"""
+    text = str(value).strip()
+    if text.endswith('.0'):
+        text = text[:-2]
+    if not text.isdigit():
+        return None
+    number = int(text)
+    if not 1 <= number <= 65535:
+        return None
+    return text if text.isascii() and text[0] != '0' else str(number)
+
+def ip_to_int(ip):
+    """IP地址转为整数（IPv4 32位 / IPv6 128位），非法地址返回None"""
+    text = str(ip).strip().strip('[]')
+    if ':' in text:
+        try:
+            return int(ipaddress.IPv6Address(text.split('%')[0]))
+        except ValueError:
+            return None
+    # 标准写法由 inet_pton 直接转换，带前导零等写法再逐个八位组解析
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, text), 'big')
+    except (OSError, ValueError):
+        pass
+    parts = text.split('.')
+    if len(parts) != 4:
+        return None
+    value = 0
+    for part in parts:
+        if not part.isdigit() or int(part) > 255:
+            return None
+        value = (value << 8) | int(part)
+    return value
+
+def ip_sort_key(ip):
+    """IP排序键：IPv4在前、IPv6在后，按数值排序；非IP按文本排在最后"""
+    value = ip_to_int(ip)
+    if value is None:
+        return (1, 0, str(ip))
+    if ':' in str(ip):
+        value |= 1 << 128
+    return (0, value, '')
+
+def split_host_port(value):
+    """拆分 主机:端口，支持 [IPv6]:端口；裸IPv6地址视为无端口"""
+    text = str(value).strip()
+    match = re.match(r'^\[([^\]]+)\](?::(\d+))?$', text)
+    if match:
+        return match.group(1), match.group(2)
+    if text.count(':') == 1:
+        host, port = text.split(':')
+        if port.isdigit():
+            return host, port
+    return text, None
+
+def join_ip_port(ip, port, separator=':'):
+    """拼接IP和端口，IPv6 使用 [地址]:端口 形式"""
+    if separator == ':' and ':' in ip:
+        ip = f"[{ip}]"
+    return f"{ip}{separator}{port}"
+
+def port_required(extract_mode):
+    """该提取模式是否要求有端口（仅IP、CIDR聚合和规范记录模式端口可选）"""
+    return extract_mode not in PORT_OPTIONAL_MODES
+
+# 规范记录模式：端口可缺省，一次提取为 Record 后再按各输出模式格式化
+RECORD_MODE = "record"
+PORT_OPTIONAL_MODES = {"ip_only", "cidr", RECORD_MODE}
+
+def render_records(records, extract_mode, default_port="", seen=None):
+    """将 Record 按输出模式格式化：补默认端口、去重，并按 IP、端口（补上的默认端口）排序"""
+    addresses, hosts = [], []
+    seen = set() if seen is None else seen
+    port_value = int(default_port) if default_port else 0
+    for record in records:
+        result_item = record.format(extract_mode, default_port)
+        if result_item is None or result_item in seen:
+            continue
+        seen.add(result_item)
+        # 与 Record.sort_key 顺序相同；同一端点中原本无端口的记录排在前面，其余保持输入顺序
+        port = record.port or port_value
+        if record.version:
+            # IP 按 (地址, 端口, 原本有无端口) 拼成一个整数排序，比逐个比较元组快得多
+            address = record.ip | (1 << 128) if record.version == 6 else record.ip
+            addresses.append((((address << 17 | port + 1) << 1) | bool(record.port), result_item))
+        else:
+            hosts.append(((record.host, port or -1, bool(record.port)), result_item))
+    addresses.sort(key=lambda item: item[0])
+    hosts.sort(key=lambda item: item[0])
+    return [result_item for _, result_item in addresses] + [result_item for _, result_item in hosts]
+
+# CIDR 或 起始IP-结束IP 形式的地址段
+CIDR_SPEC_RE = re.compile(
+    r'(' + IPV4_PATTERN + r'/\d{1,2}'
+    + r'|' + IPV4_PATTERN + r'\s*-\s*' + IPV4_PATTERN
+    + r'|\[?(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{0,4}\]?/\d{1,3})'
+)
+# 未设置上限和抽样时允许展开的最大地址段
+MAX_EXPAND_SIZE = 1 << 24
+
+def has_ip_range_spec(file_path, max_lines=20):
+    """检测文本文件开头是否包含CIDR/IP段"""
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for _ in range(max_lines):
+                line = f.readline()
+                if not line:
+                    break
+                match = CIDR_SPEC_RE.search(line)
+                if match and parse_ip_range_spec(match.group(1)):
+                    return True
+    except OSError:
+        pass
+    return False
+
+def parse_ip_range_spec(spec):
+    """解析 CIDR 或 起始IP-结束IP，返回 (起始整数, 结束整数, IP版本)，无法解析返回None"""
+    spec = spec.replace('[', '').replace(']', '').strip()
+    try:
+        if '/' in spec:
+            network = ipaddress.ip_network(spec, strict=False)
+            return int(network.network_address), int(network.broadcast_address), network.version
+        start_ip, end_ip = [part.strip() for part in spec.split('-')]
+        start, end = ipaddress.IPv4Address(start_ip), ipaddress.IPv4Address(end_ip)
+        if end < start:
+            return None
+        return int(start), int(end), 4
+    except ValueError:
+        return None
+
+def iter_ip_range(start, end, version, sample=None):
+    """惰性生成区间内的IP地址，可随机抽样指定数量"""
+    size = end - start + 1
+    if sample and sample < size:
+        if size > sys.maxsize:
+            offsets = sorted(set(random.randrange(size) for _ in range(sample)))
+        else:
+            offsets = sorted(random.sample(range(size), sample))
+    else:
+        offsets = range(size)
+    address_class = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+    for offset in offsets:
+        yield str(address_class(start + offset))
+
+def iter_expand_lines(lines, limit=None, sample=None):
+    """逐行展开 CIDR/IP段（生成器，不一次性生成全部地址），其余行原样输出"""
+    expanded_count = 0
+    for line in lines:
+        match = CIDR_SPEC_RE.search(line)
+        ip_range = parse_ip_range_spec(match.group(1)) if match else None
+        if not ip_range:
+            yield line
+            continue
+        
+        start, end, version = ip_range
+        if not limit and not sample and end - start + 1 > MAX_EXPAND_SIZE:
+            print(f"⚠️  地址段 {match.group(1)} 过大，请设置展开上限或抽样数量，已跳过")
+            continue
+        
+        # 达到上限后不再展开地址段，普通行照常输出
+        prefix, suffix = line[:match.start()], line[match.end():]
+        for ip in iter_ip_range(start, end, version, sample):
+            if limit and expanded_count >= limit:
+                break
+            expanded_count += 1
+            yield f"{prefix}[{ip}]{suffix}" if version == 6 else f"{prefix}{ip}{suffix}"
+
+def collapse_ip_ints(values, bits):
+    """将整数IP合并为最少的CIDR块：先排序合并连续区间，再按对齐拆分，返回 (网络整数, 前缀长度) 列表"""
+    blocks = []
+    values = sorted(set(values))
+    i = 0
+    while i < len(values):
+        start = end = values[i]
+        i += 1
+        while i < len(values) and values[i] == end + 1:
+            end = values[i]
+            i += 1
+        
+        while start <= end:
+            size = start & -start if start else 1 << bits
+            while size > end - start + 1:
+                size >>= 1
+            blocks.append((start, bits - size.bit_length() + 1))
+            start += size
+    return blocks
+
+def collapse_results_to_cidr(results):
+    """将结果中的IP聚合为CIDR块，带端口时按端口分别聚合；非IP行原样保留"""
+    output = []
+    groups = {}
+    
+    def flush():
+        for port in sorted(groups, key=lambda p: -1 if p is None else int(p)):
+            for version, bits in [(4, 32), (6, 128)]:
+                address_class = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+                for start, prefix in collapse_ip_ints(groups[port][version], bits):
+                    cidr = f"{address_class(start)}/{prefix}"
+                    output.append(f"{cidr} {port}" if port else cidr)
+            output.extend(groups[port]['other'])
+        groups.clear()
+    
+    for line in results:
+        if line.startswith('-----'):
+            flush()
+            output.append(line)
+            continue
+        ip, port, _ = parse_result_line(line)
+        group = groups.setdefault(port, {4: [], 6: [], 'other': []})
+        value = ip_to_int(ip) if ip else None
+        if value is None:
+            group['other'].append(line)
+        else:
+            group[6 if ':' in ip else 4].append(value)
+    flush()
+    
+    print(f"✅ CIDR聚合完成: {len([line for line in results if not line.startswith('-----')])} 条 → {len([line for line in output if not line.startswith('-----')])} 条")
+    return output
 
 def clean_ip(ip_str):
     """清理IP地址"""
@@ -18,14 +321,380 @@ def clean_ip(ip_str):
     ip_str = re.sub(r'^https?://', '', ip_str)
     if '/' in ip_str:
         ip_str = ip_str.split('/')[0]
+    # IPv6 统一为标准写法，保证等价写法能正确去重
+    host, port = split_host_port(ip_str)
+    normalized = normalize_ip(host)
+    if normalized:
+        ip_str = join_ip_port(normalized, port) if port else normalized
     return ip_str
 
+# 私有地址段（RFC 1918 / RFC 4193）
+PRIVATE_NETWORKS = [ipaddress.ip_network(net) for net in ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', 'fc00::/7']]
+
+def parse_ip_address(ip):
+    """解析为 ipaddress 对象（忽略区域ID），非法地址返回None"""
+    try:
+        return ipaddress.ip_address(str(ip).strip().strip('[]').split('%')[0])
+    except ValueError:
+        return None
+
+def is_private_ip(ip):
+    """是否为私有地址"""
+    address = parse_ip_address(ip)
+    return address is not None and any(address in network for network in PRIVATE_NETWORKS if address.version == network.version)
+
+def is_bogon_ip(ip):
+    """是否为不可公网路由的地址（私有、保留、回环、链路本地、组播、文档地址等）"""
+    address = parse_ip_address(ip)
+    if address is None:
+        return False
+    return not address.is_global or address.is_multicast or address.is_reserved
+
+# 校验阶段可选丢弃的地址类别；IPv4 使用固定的地址段表，便于对整列向量化判断
+DROP_CATEGORIES = ['private', 'reserved', 'bogon']
+IPV4_DROP_NETWORKS = {
+    'private': ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16'],
+    'reserved': ['0.0.0.0/8', '127.0.0.0/8', '169.254.0.0/16', '224.0.0.0/3'],
+}
+IPV4_DROP_NETWORKS['bogon'] = IPV4_DROP_NETWORKS['private'] + IPV4_DROP_NETWORKS['reserved'] + [
+    '100.64.0.0/10', '192.0.0.0/24', '192.0.2.0/24', '198.18.0.0/15', '198.51.100.0/24', '203.0.113.0/24',
+]
+
+def build_ipv4_range_table(networks):
+    """将地址段列表转换为按起始地址排序的 (起始数组, 结束数组)"""
+    ranges = sorted((int(net.network_address), int(net.broadcast_address)) for net in map(ipaddress.ip_network, networks))
+    return np.array([start for start, _ in ranges], dtype=np.int64), np.array([end for _, end in ranges], dtype=np.int64)
+
+IPV4_DROP_TABLES = {category: build_ipv4_range_table(networks) for category, networks in IPV4_DROP_NETWORKS.items()}
+
+def ipv6_in_category(ip, category):
+    """IPv6 地址是否属于指定类别"""
+    if category == 'private':
+        return is_private_ip(ip)
+    if category == 'bogon':
+        return is_bogon_ip(ip)
+    address = parse_ip_address(ip)
+    return address is not None and (address.is_reserved or address.is_loopback or address.is_link_local
+                                    or address.is_multicast or address.is_unspecified)
+
+class EndpointValidator:
+    """IP/端口校验与规范化：八位组和端口按整数解析，拒绝越界值，可选丢弃私有/保留/bogon地址，并统计被拒绝的记录"""
+    
+    def __init__(self, drop=None):
+        self.drop = [category for category in DROP_CATEGORIES if category in (drop or [])]
+        self.rejected = {}
+    
+    def reject(self, reason, count=1):
+        if count:
+            self.rejected[reason] = self.rejected.get(reason, 0) + count
+    
+    def dropped_category(self, ip):
+        """返回IP命中的丢弃类别，未命中返回None"""
+        if ':' in ip:
+            return next((category for category in self.drop if ipv6_in_category(ip, category)), None)
+        value = ip_to_int(ip)
+        for category in self.drop:
+            starts, ends = IPV4_DROP_TABLES[category]
+            index = bisect.bisect_right(starts, value) - 1
+            if index >= 0 and value <= ends[index]:
+                return category
+        return None
+    
+    def check(self, ip, port=None, allow_hostname=False):
+        """逐条校验（文本流）：返回规范的 (IP, 端口)，端口缺省时为None；不合法返回 (None, None)
+        
+        allow_hostname: 非IP的主机名（如链接中的域名）原样保留
+        """
+        canonical = normalize_ip(ip)
+        if canonical is None:
+            if not (allow_hostname and not re.match(r'^[\d.]+$', str(ip))):
+                self.reject('ip')
+                return None, None
+            canonical = str(ip).strip()
+        elif self.drop:
+            category = self.dropped_category(canonical)
+            if category:
+                self.reject(category)
+                return None, None
+        if port is None or str(port).strip() == "":
+            return canonical, None
+        port = canonical_port(port)
+        if port is None:
+            self.reject('port')
+            return None, None
+        return canonical, port
+    
+    def validate_series(self, ips, ports=None):
+        """向量化校验DataFrame列：返回 (有效行掩码, 规范IP列, 规范端口列)；空端口视为缺省，不算非法"""
+        ips = ips.fillna('').astype(str).str.strip()
+        canonical = pd.Series('', index=ips.index, dtype=object)
+        
+        octets = ips.str.extract(IPV4_OCTETS_RE.pattern)
+        is_v4 = octets[0].notna()
+        octets = octets[is_v4].astype(np.int64)
+        v4_ok = pd.Series(False, index=ips.index)
+        v4_ok[is_v4] = (octets <= 255).all(axis=1).values
+        octets = octets[v4_ok[is_v4].values]
+        canonical[v4_ok] = octets[0].astype(str) + '.' + octets[1].astype(str) + '.' + octets[2].astype(str) + '.' + octets[3].astype(str)
+        v4_values = (octets[0] * 16777216 + octets[1] * 65536 + octets[2] * 256 + octets[3]).values
+        
+        # 非IPv4（IPv6 等）按不同取值逐个规范化
+        others = ips[~is_v4]
+        lookup = {value: normalize_ip(value) for value in others.unique()}
+        others = others.map(lookup)
+        canonical[others.index] = others.fillna('')
+        mask = v4_ok | canonical.ne('')
+        self.reject('ip', int((~mask).sum()))
+        
+        for category in self.drop:
+            starts, ends = IPV4_DROP_TABLES[category]
+            index = np.searchsorted(starts, v4_values, side='right') - 1
+            hit = pd.Series(False, index=ips.index)
+            hit[v4_ok] = (index >= 0) & (v4_values <= ends[np.maximum(index, 0)])
+            v6 = mask & ~v4_ok
+            hit[v6] = canonical[v6].map(lambda ip: ipv6_in_category(ip, category)).astype(bool)
+            hit &= mask
+            self.reject(category, int(hit.sum()))
+            mask &= ~hit
+        
+        port_canonical = None
+        if ports is not None:
+            numbers = pd.to_numeric(ports, errors='coerce')
+            empty = ports.isna() | ports.astype(str).str.strip().eq('')
+            port_ok = numbers.notna() & (numbers == numbers.round()) & numbers.between(1, 65535)
+            bad_port = mask & ~empty & ~port_ok
+            self.reject('port', int(bad_port.sum()))
+            mask &= ~bad_port
+            port_canonical = pd.Series('', index=ips.index, dtype=object)
+            port_canonical[port_ok] = numbers[port_ok].astype(np.int64).astype(str)
+        return mask, canonical, port_canonical
+    
+    def summary(self):
+        names = {'ip': 'IP非法', 'port': '端口非法', 'private': '私有地址', 'reserved': '保留地址', 'bogon': 'bogon地址'}
+        return "，".join(f"{names[reason]} {count}" for reason, count in self.rejected.items())
+
+def print_validation_summary(validator):
+    """输出校验阶段被拒绝的记录数"""
+    if validator is not None and validator.rejected:
+        print(f"🧹 校验排除了 {sum(validator.rejected.values())} 条记录（{validator.summary()}）")
+
 def get_safe_output_path(filename):
     """获取安全的输出文件路径"""
-    if not filename.lower().endswith('.txt'):
+    if not filename.lower().endswith('.txt') and not get_columnar_format(filename):
         filename += '.txt'
     return str(Path.cwd() / filename)
 
+# 列式文件格式（扩展名 → 格式），依赖 pyarrow，按需导入
+COLUMNAR_FORMATS = {
+    '.parquet': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'arrow',
+    '.ipc': 'arrow',
+}
+
+def get_columnar_format(file_path):
+    """根据扩展名判断是否为列式格式，返回格式名或None"""
+    return COLUMNAR_FORMATS.get(os.path.splitext(str(file_path))[1].lower())
+
+def import_pyarrow():
+    """按需导入pyarrow，未安装时给出提示"""
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+        return pa
+    except ImportError:
+        raise RuntimeError("列式格式需要安装 pyarrow: pip install pyarrow")
+
+def parse_result_line(line):
+    """将输出行拆分为 (IP, 端口, 备注)，支持 IP 端口 / IP:端口#备注 / [IPv6]:端口 / 仅IP"""
+    body, has_remark, remark = line.strip().partition('#')
+    body = body.strip()
+    if ' ' in body:
+        ip, _, port = body.partition(' ')
+        port = port.strip()
+    else:
+        ip, port = split_host_port(body)
+    if not ip or ' ' in ip or (port and not port.isdigit()):
+        return None, None, None
+    return ip, port or None, remark if has_remark else None
+
+def result_sort_key(line):
+    """输出行排序键：按IP数值、端口数值排序，避免按字符串排序；同一端点保持原有先后顺序"""
+    ip, port, _ = parse_result_line(line)
+    if ip is None:
+        return (1, 0, line, -1)
+    return ip_sort_key(ip) + (int(port) if port else -1,)
+
+def build_record_frame(lines, extra_columns=None):
+    """将输出行转换为带类型的列式表: ip/port/remark/ip_int/ip_packed + 附加的源列
+    
+    CIDR 行拆为网络地址（ip 及其数值列）和前缀长度（prefix 列，仅在有 CIDR 行时写出）
+    """
+    sheets, ips, prefixes, ports, remarks = [], [], [], [], []
+    sheet_name = ""
+    for line in lines:
+        if line.startswith('-----'):
+            sheet_name = line.strip('- ')
+            continue
+        ip, port, remark = parse_result_line(line)
+        network, slash, prefix = (ip or '').partition('/')
+        if slash and prefix.isdigit():
+            ip = network
+        sheets.append(sheet_name)
+        ips.append(ip if ip is not None else line)
+        prefixes.append(int(prefix) if slash and prefix.isdigit() else None)
+        ports.append(int(port) if port and int(port) <= 65535 else None)
+        remarks.append(remark)
+    
+    ip_ints = [ip_to_int(ip) for ip in ips]
+    versions = [None if value is None else (6 if ':' in ip else 4) for ip, value in zip(ips, ip_ints)]
+    df = pd.DataFrame({
+        'ip': pd.array(ips, dtype='string'),
+        'port': pd.array(ports, dtype='UInt16'),
+        'remark': pd.array(remarks, dtype='string'),
+        'ip_version': pd.array(versions, dtype='UInt8'),
+        # ip_int 仅保存IPv4；ip_packed 为大端字节（IPv4 4字节 / IPv6 16字节）
+        'ip_int': pd.array([value if version == 4 else None for value, version in zip(ip_ints, versions)], dtype='UInt32'),
+        'ip_packed': [value.to_bytes(4 if version == 4 else 16, 'big') if value is not None else None
+                      for value, version in zip(ip_ints, versions)],
+    })
+    if any(prefix is not None for prefix in prefixes):
+        df.insert(1, 'prefix', pd.array(prefixes, dtype='UInt8'))
+    if any(sheets):
+        df.insert(0, 'sheet', pd.array(sheets, dtype='string'))
+    
+    # 附加custom_mode选择的源列，能转为数值的列保存为数值类型
+    for name, values in (extra_columns or {}).items():
+        column = pd.Series(values, dtype='string')
+        try:
+            column = pd.to_numeric(column)
+        except (ValueError, TypeError):
+            pass
+        name = str(name)
+        df[name if name not in df.columns else f"src_{name}"] = column.values
+    return df
+
+def write_columnar_output(df, output_path):
+    """写出列式文件；Feather/Arrow IPC 不压缩，下游可内存映射零拷贝读取"""
+    pa = import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    file_format = get_columnar_format(output_path)
+    if file_format == 'parquet':
+        pa.parquet.write_table(table, output_path)
+    else:
+        # Feather v2 即 Arrow IPC 文件格式
+        with pa.OSFile(output_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+def read_columnar_file(file_path, where=None):
+    """读取列式文件为DataFrame（内存映射读取），读取失败时抛出异常"""
+    pa = import_pyarrow()
+    if get_columnar_format(file_path) == 'parquet':
+        table = pa.parquet.read_table(file_path, memory_map=True)
+    else:
+        with pa.memory_map(file_path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+    # 打包的数值列不参与文本处理
+    table = table.drop([name for name in ('ip_int', 'ip_packed') if name in table.column_names])
+    df = table.to_pandas()
+    # CIDR 输出的网络地址和前缀长度合回 地址/前缀
+    if 'ip' in df.columns and 'prefix' in df.columns:
+        has_prefix = df['prefix'].notna()
+        df.loc[has_prefix, 'ip'] = df.loc[has_prefix, 'ip'] + '/' + df.loc[has_prefix, 'prefix'].astype(str)
+        df = df.drop(columns='prefix')
+    if where:
+        df = where.filter_frame(df)
+    logger.info(f"✅ 成功读取列式文件，共 {len(df)} 行")
+    return df
+
+SUBSCRIPTION_BUFFER_SIZE = 1 << 16
+
+class Base64Writer:
+    """增量 base64 编码：写入的数据累积到缓冲区后按 3 字节对齐分段编码，结果与整体编码相同，内存只占用一个缓冲区"""
+    
+    def __init__(self, stream, buffer_size=SUBSCRIPTION_BUFFER_SIZE):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+    
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            cut = len(self.buffer) - len(self.buffer) % 3
+            self.stream.write(base64.b64encode(self.buffer[:cut]))
+            del self.buffer[:cut]
+    
+    def close(self):
+        """编码剩余数据（含填充）"""
+        if self.buffer:
+            self.stream.write(base64.b64encode(self.buffer))
+            self.buffer.clear()
+
+def write_stdout_lines(lines, base64_encode=False):
+    """将结果行写到标准输出（提示信息此时写到标准错误），返回写出的行数"""
+    stream = sys.__stdout__.buffer
+    writer = Base64Writer(stream) if base64_encode else stream
+    count = 0
+    for line in lines:
+        writer.write((line + '\n').encode('utf-8'))
+        count += 1
+    if base64_encode:
+        writer.close()
+    stream.flush()
+    return count
+
+def write_results_file(lines, output_path, extra_columns=None, base64_encode=False):
+    """保存结果：按扩展名写出文本或列式文件；先写入同目录临时文件再替换，读取方不会看到写了一半的文件
+    
+    lines 可以是生成器（文本输出边生成边写入），返回写出的行数
+    base64_encode: 整个文本内容边写边做 base64 编码（订阅格式）
+    """
+    directory, name = os.path.split(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=os.path.splitext(name)[1])
+    count = 0
+    try:
+        if get_columnar_format(output_path):
+            os.close(fd)
+            df = build_record_frame(list(lines), extra_columns)
+            write_columnar_output(df, temp_path)
+            count = len(df)
+        elif base64_encode:
+            with open(fd, 'wb') as f:
+                encoder = Base64Writer(f)
+                for line in lines:
+                    encoder.write((line + '\n').encode('utf-8'))
+                    count += 1
+                encoder.close()
+        else:
+            with open(fd, 'w', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(line + '\n')
+                    count += 1
+        # mkstemp 创建的文件权限为 0600，改为与普通新建文件一致
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return count
+
+def classify_ip_value(value):
+    """判断单个值的IP类型: ip_port / ip_only / mixed，不含IP返回None"""
+    text = str(value).strip()
+    host, port = split_host_port(text)
+    if port and normalize_ip(host):
+        return 'ip_port'
+    if normalize_ip(text):
+        return 'ip_only'
+    if extract_ip_port_pair(text)[0]:
+        return 'mixed'
+    return None
+
 def detect_column_content_type(column_data):
     """智能检测列内容类型"""
     if not column_data or len(column_data) == 0:
@@ -36,12 +705,12 @@ def detect_column_content_type(column_data):
     mixed_count = 0
     
     for value in column_data[:10]:
-        str_value = str(value).strip()
-        if re.match(r'^\d+\.\d+\.\d+\.\d+:\d+$', str_value):
+        value_type = classify_ip_value(value)
+        if value_type == 'ip_port':
             ip_port_count += 1
-        elif re.match(r'^\d+\.\d+\.\d+\.\d+$', str_value):
+        elif value_type == 'ip_only':
             ip_only_count += 1
-        elif re.match(r'.*\d+\.\d+\.\d+\.\d+.*', str_value):
+        elif value_type == 'mixed':
             mixed_count += 1
     
     if ip_port_count > 0:
@@ -53,24 +722,46 @@ def detect_column_content_type(column_data):
     else:
         return 'other'
 
-def extract_ip_port_from_mixed(text):
-    """从混合文本中提取IP和端口"""
+def extract_ip_port_pair(text):
+    """从混合文本中提取 (IP, 端口)，没有端口时端口为None，未找到IP返回 (None, None)
+    
+    >>> extract_ip_port_pair("[2001:db8::1]:443 香港")
+    ('2001:db8::1', '443')
+    >>> extract_ip_port_pair("Note :: see below")
+    (None, None)
+    """
+    text = str(text)
+    
+    # 尝试匹配 [IPv6]:端口 格式（没有 [ 的行不必扫描）
+    if '[' in text:
+        for match in IPV6_BRACKET_PORT_RE.finditer(text):
+            ip = normalize_ip(match.group(1))
+            if ip:
+                return ip, match.group(2)
+    
     # 尝试匹配 IP:端口 格式
-    ip_port_match = re.search(r'(\d+\.\d+\.\d+\.\d+):(\d+)', text)
+    ip_port_match = IPV4_PORT_RE.search(text)
     if ip_port_match:
-        return f"{ip_port_match.group(1)}:{ip_port_match.group(2)}"
+        return ip_port_match.group(1), ip_port_match.group(2)
     
     # 尝试匹配 IP,端口 格式（逗号分隔）
-    ip_comma_port_match = re.search(r'(\d+\.\d+\.\d+\.\d+)\s*,\s*(\d+)', text)
+    ip_comma_port_match = IPV4_COMMA_PORT_RE.search(text)
     if ip_comma_port_match:
-        return f"{ip_comma_port_match.group(1)}:{ip_comma_port_match.group(2)}"
+        return ip_comma_port_match.group(1), ip_comma_port_match.group(2)
+    
+    # 尝试匹配IPv6（压缩写法、区域ID、[地址]），可跟逗号分隔的端口
+    for match in IPV6_RE.finditer(text):
+        ip = normalize_ip(match.group(1))
+        if ip:
+            port_match = IPV6_COMMA_PORT_RE.match(text[match.end():])
+            return ip, port_match.group(1) if port_match else None
     
     # 尝试匹配纯IP
-    ip_only_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', text)
+    ip_only_match = IPV4_RE.search(text)
     if ip_only_match:
-        return ip_only_match.group(1)
+        return ip_only_match.group(1), None
     
-    return None
+    return None, None
 
 def is_special_format_file(file_path):
     """检测文件是否为特殊格式文件（包含vless、trojan等协议）"""
@@ -91,7 +782,7 @@ def parse_special_format(line):
     
     # 匹配各种特殊协议
     patterns = [
-        r'^(vless|trojan|vmess)://[^@]+@([^:]+):(\d+)[^#]*(#.*)?',  # vless/trojan/vmess
+        r'^(vless|trojan|vmess)://[^@]+@(\[[^\]]+\]|[^:]+):(\d+)[^#]*(#.*)?',  # vless/trojan/vmess，支持[IPv6]
         r'^ss://[^#]+#(.+)$',  # ss
     ]
     
@@ -111,76 +802,135 @@ def parse_special_format(line):
                 except:
                     pass
                 
-                return f"{domain}:{port}{remark}"
+                domain = normalize_ip(domain) or domain
+                return f"{join_ip_port(domain, port)}{remark}"
     
     return None
 
-def extract_special_format(file_path):
-    """从特殊格式文件中提取信息"""
-    print("🔍 正在提取文件信息...")
+class LinkTemplate:
+    """节点链接模板：保留原链接的 UUID/密码和参数，生成时只替换地址、端口和备注
     
-    results = []
-    seen = set()
+    支持 vless/trojan 等 协议://用户信息@主机:端口?参数#备注 形式、vmess（base64 JSON）和 ss（含旧式整体 base64）
+    """
     
-    try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            special_info = parse_special_format(line)
-            if special_info and special_info not in seen:
-                seen.add(special_info)
-                results.append(special_info)
-        
-        results.sort()
-        return results
+    def __init__(self, link):
+        link = link.strip()
+        scheme, separator, rest = link.partition('://')
+        if not separator:
+            raise ValueError(f"无法识别的链接模板: {link[:60]}")
+        self.scheme = scheme.lower()
+        body, _, self.remark = rest.partition('#')
+        self.remark = urllib.parse.unquote(self.remark)
         
-    except Exception as e:
-        print(f"❌ 处理文件失败: {e}")
-        return []
-
-def process_excel_file(file_path, selected_sheets=None):
-    """处理Excel文件 - 支持多工作表选择"""
-    try:
-        excel_file = pd.ExcelFile(file_path)
-        sheet_names = excel_file.sheet_names
+        if self.scheme == 'vmess':
+            self.config = json.loads(decode_base64_text(body))
+            self.remark = self.config.get('ps', '')
+            return
         
-        if selected_sheets:
-            dfs = {}
-            for sheet_name in selected_sheets:
-                if sheet_name in sheet_names:
-                    df = pd.read_excel(file_path, sheet_name=sheet_name)
-                    dfs[sheet_name] = df
-                    print(f"✅ 成功读取工作表 '{sheet_name}'，共 {len(df)} 行")
-                else:
-                    print(f"⚠️  工作表 '{sheet_name}' 不存在，已跳过")
-            return dfs
+        if self.scheme == 'ss' and '@' not in body:
+            # 旧式 ss://base64(加密方式:密码@主机:端口)，改写为 SIP002 形式
+            userinfo, _, host_part = decode_base64_text(body).rpartition('@')
+            userinfo = base64.urlsafe_b64encode(userinfo.encode('utf-8')).decode('ascii').rstrip('=')
         else:
-            print(f"✅ 检测到Excel文件，包含以下工作表: {sheet_names}")
-            print("\n📊 请选择要处理的工作表(输入数字，多选用空格分隔，如: 1 2 3):")
-            for i, sheet in enumerate(sheet_names, 1):
-                print(f"  {i}. {sheet}")
-            
-            sheet_choices = input("选择工作表(默认1): ").strip().split()
-            if not sheet_choices:
-                sheet_choices = ["1"]
-            
-            selected_dfs = {}
-            for choice in sheet_choices:
-                if choice.isdigit() and 1 <= int(choice) <= len(sheet_names):
-                    sheet_name = sheet_names[int(choice)-1]
-                    df = pd.read_excel(file_path, sheet_name=sheet_name)
-                    selected_dfs[sheet_name] = df
-                    print(f"✅ 成功读取工作表 '{sheet_name}'，共 {len(df)} 行")
-                else:
-                    print(f"⚠️  无效选择: {choice}，已跳过")
+            userinfo, _, host_part = body.rpartition('@')
+        match = re.match(r'^(\[[^\]]+\]|[^:/?\[\]]+):(\d+)(.*)$', host_part)
+        if not userinfo or not match:
+            raise ValueError(f"链接模板中没有 用户信息@主机:端口: {link[:60]}")
+        self.prefix = f"{scheme}://{userinfo}@"
+        self.suffix = match.group(3)
+    
+    def render(self, host, port, remark=None):
+        """生成一条链接；没有备注时使用 主机:端口 作为节点名"""
+        remark = remark or join_ip_port(host, port)
+        if self.scheme == 'vmess':
+            config = dict(self.config)
+            config['add'] = host
+            config['port'] = int(port) if isinstance(self.config.get('port'), int) else str(port)
+            config['ps'] = remark
+            payload = json.dumps(config, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            return 'vmess://' + base64.b64encode(payload).decode('ascii')
+        return f"{self.prefix}{join_ip_port(host, port)}{self.suffix}#{urllib.parse.quote(remark)}"
+
+def decode_base64_text(text):
+    """解码 base64 文本（兼容 URL 安全字符和缺少的填充）"""
+    text = urllib.parse.unquote(text.strip())
+    return base64.urlsafe_b64decode(text.replace('+', '-').replace('/', '_') + '=' * (-len(text) % 4)).decode('utf-8')
+
+def load_link_template(value=None, input_path=None):
+    """读取链接模板：value 可以是链接本身或包含链接的文件；未指定时使用 input_path（输入的链接文件）中的第一条链接，找不到返回None"""
+    if value and '://' in value:
+        return LinkTemplate(value)
+    path = value or input_path
+    if not path:
+        return None
+    if not os.path.exists(path):
+        raise ValueError(f"链接模板文件不存在: {path}")
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        link = next((line.strip() for line in f if '://' in line), None)
+    return LinkTemplate(link) if link else None
+
+def iter_special_endpoints(lines, where=None, validator=None):
+    """逐行解析特殊格式链接为 (行号, 主机, 端口, 备注)，主机可以是域名（生成器，不去重）"""
+    validator = EndpointValidator() if validator is None else validator
+    
+    for row, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
             
-            return selected_dfs if selected_dfs else None
-        
+        special_info = parse_special_format(line)
+        if not special_info:
+            continue
+        ip, port, remark = parse_result_line(special_info)
+        ip, port = validator.check(ip, port, allow_hostname=True)
+        if ip is None:
+            continue
+        if where and not where.match(ip, port, remark):
+            continue
+        yield row, ip, port, remark
+
+def ask_excel_sheets(file_path):
+    """交互选择要处理的Excel工作表，返回工作表名列表"""
+    sheet_names = pd.ExcelFile(file_path).sheet_names
+    print(f"✅ 检测到Excel文件，包含以下工作表: {sheet_names}")
+    print("\n📊 请选择要处理的工作表(输入数字，多选用空格分隔，如: 1 2 3):")
+    for i, sheet in enumerate(sheet_names, 1):
+        print(f"  {i}. {sheet}")
+    
+    sheet_choices = input("选择工作表(默认1): ").strip().split()
+    if not sheet_choices:
+        sheet_choices = ["1"]
+    
+    selected_sheets = []
+    for choice in sheet_choices:
+        if choice.isdigit() and 1 <= int(choice) <= len(sheet_names):
+            selected_sheets.append(sheet_names[int(choice)-1])
+        else:
+            print(f"⚠️  无效选择: {choice}，已跳过")
+    return selected_sheets
+
+def read_excel_frames(file_path, sheets, where=None):
+    """读取Excel的指定工作表为 {工作表名: DataFrame}，有过滤条件时每个工作表读入后立即过滤；工作表不存在时抛出异常"""
+    sheet_names = pd.ExcelFile(file_path).sheet_names
+    missing = [str(sheet_name) for sheet_name in sheets if sheet_name not in sheet_names]
+    if missing:
+        raise ValueError(f"工作表不存在: {', '.join(missing)}")
+    
+    dfs = {}
+    for sheet_name in sheets:
+        df = pd.read_excel(file_path, sheet_name=sheet_name)
+        if where:
+            df = where.filter_frame(df)
+        dfs[sheet_name] = df
+        logger.info(f"✅ 成功读取工作表 '{sheet_name}'，共 {len(df)} 行")
+    return dfs
+
+def process_excel_file(file_path, selected_sheets=None, where=None):
+    """处理Excel文件 - 支持多工作表选择（未指定工作表时交互选择）；读取失败时提示并返回None"""
+    try:
+        if not selected_sheets:
+            selected_sheets = ask_excel_sheets(file_path)
+        return read_excel_frames(file_path, selected_sheets, where) or None
     except Exception as e:
         print(f"❌ Excel文件读取失败: {e}")
         return None
@@ -201,6 +951,10 @@ def smart_parse_text(file_path):
     if not lines:
         return None
     
+    # 含IPv6地址时冒号不能作为分隔符
+    if any(extract_ip_port_pair(line)[0] and ':' in extract_ip_port_pair(line)[0] for line in lines[:50]):
+        separators.remove(':')
+    
     separator_scores = {}
     for sep in separators:
         score = 0
@@ -251,11 +1005,12 @@ def smart_parse_text(file_path):
         
         if sample_values:
             first_value = sample_values[0]
-            if re.match(r'^\d+\.\d+\.\d+\.\d+:\d+$', first_value):
+            value_type = classify_ip_value(first_value)
+            if value_type == 'ip_port':
                 col_type = "IP:端口"
-            elif re.match(r'^\d+\.\d+\.\d+\.\d+$', first_value):
+            elif value_type == 'ip_only':
                 col_type = "IP地址"
-            elif re.match(r'.*\d+\.\d+\.\d+\.\d+.*', first_value):
+            elif value_type == 'mixed':
                 col_type = "混合内容"
             elif first_value.isdigit() and 1 <= int(first_value) <= 65535:
                 col_type = "端口"
@@ -265,108 +1020,86 @@ def smart_parse_text(file_path):
     print(f"✅ 成功解析为 {len(data)} 行 × {max_columns} 列")
     return pd.DataFrame(data, columns=columns)
 
-def process_csv_file(file_path):
-    """处理CSV文件"""
-    try:
-        # 尝试多种编码方式
-        encodings = ['utf-8', 'gbk', 'utf-8-sig', 'latin-1']
-        df = None
-        
-        for encoding in encodings:
-            try:
+def read_csv_frame(file_path, where=None):
+    """读取CSV文件为DataFrame（有过滤条件时分块读取，每块读入后立即过滤）；无法读取时抛出异常"""
+    # 尝试多种编码方式
+    encodings = ['utf-8', 'gbk', 'utf-8-sig', 'latin-1']
+    for encoding in encodings:
+        try:
+            if where:
+                chunks = pd.read_csv(file_path, encoding=encoding, chunksize=CSV_CHUNK_SIZE)
+                # 保留原始行号，便于记录回溯到源文件的行
+                df = pd.concat([where.filter_frame(chunk) for chunk in chunks])
+            else:
                 df = pd.read_csv(file_path, encoding=encoding)
-                print(f"✅ 成功读取CSV文件({encoding})，共 {len(df)} 行")
-                break
-            except:
-                continue
-        
-        if df is None:
-            # 如果标准方法都失败，尝试手动解析
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    lines = f.readlines()
-                
-                data = []
-                headers = None
-                for line in lines:
-                    if '|' in line:
-                        parts = [part.strip() for part in line.split('|') if part.strip()]
-                        if not headers and len(parts) > 1:
-                            headers = parts
-                        elif headers and len(parts) == len(headers):
-                            data.append(parts)
-                
-                if headers and data:
-                    df = pd.DataFrame(data, columns=headers)
-                    print(f"✅ 成功解析表格格式，共 {len(df)} 行")
-                    return df
-            except Exception as e:
-                print(f"❌ 文件读取失败: {e}")
-        
-        return df
+            logger.info(f"✅ 成功读取CSV文件({encoding})，共 {len(df)} 行")
+            return df
+        except WhereError:
+            raise
+        except:
+            continue
+    
+    # 如果标准方法都失败，尝试手动解析
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        lines = f.readlines()
+    
+    data = []
+    headers = None
+    for line in lines:
+        if '|' in line:
+            parts = [part.strip() for part in line.split('|') if part.strip()]
+            if not headers and len(parts) > 1:
+                headers = parts
+            elif headers and len(parts) == len(headers):
+                data.append(parts)
+    
+    if not (headers and data):
+        raise ValueError("无法识别CSV文件的编码或表格结构")
+    df = pd.DataFrame(data, columns=headers)
+    if where:
+        df = where.filter_frame(df)
+    logger.info(f"✅ 成功解析表格格式，共 {len(df)} 行")
+    return df
+
+def process_csv_file(file_path, where=None):
+    """处理CSV文件；读取失败时提示并返回None"""
+    try:
+        return read_csv_frame(file_path, where)
     except Exception as e:
         print(f"❌ CSV文件读取失败: {e}")
         return None
 
-def extract_from_text_advanced(file_path, extract_mode="ip_space_port", default_port=""):
-    """从文本文件中提取IP和端口（增强版，支持多种格式）"""
-    print(f"📝 正在从文本文件提取数据...")
-    
-    results = []
-    seen = set()
+def iter_text_endpoints(lines, extract_mode="ip_space_port", default_port="", where=None, validator=None):
+    """逐行提取文本中的 (行号, IP, 端口, 备注)：校验并规范化、补默认端口、应用过滤条件（生成器，不去重）"""
+    validator = EndpointValidator() if validator is None else validator
     
-    try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
+    for row, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('-----'):
+            continue
         
-        print(f"✅ 成功读取文件，共 {len(lines)} 行")
+        # 尝试多种提取方式，再校验范围并规范化
+        ip, port = extract_ip_port_pair(line)
+        if ip:
+            ip, port = validator.check(ip, port)
         
-        for line_num, line in enumerate(lines, 1):
-            line = line.strip()
-            if not line or line.startswith('-----'):
-                continue
-            
-            # 尝试多种提取方式
-            extracted = extract_ip_port_from_mixed(line)
+        if ip:
+            # 如果只有IP没有端口
+            if not port:
+                # 仅IP/CIDR模式直接使用IP，其他模式需要端口
+                if port_required(extract_mode) and not default_port:
+                    # 没有默认端口且需要端口，跳过
+                    continue
+                port = default_port
             
-            if extracted:
-                # 如果只有IP没有端口
-                if ':' not in extracted:
-                    # 仅IP模式直接使用IP
-                    if extract_mode == "ip_only":
-                        result_item = extracted
-                    # 其他模式需要端口
-                    elif default_port:
-                        if extract_mode == "ip_space_port":
-                            result_item = f"{extracted} {default_port}"
-                        else:
-                            result_item = f"{extracted}:{default_port}"
-                    else:
-                        # 没有默认端口且需要端口，跳过
-                        continue
-                else:
-                    # 有IP和端口
-                    if extract_mode == "ip_space_port":
-                        ip, port = extracted.split(':')
-                        result_item = f"{ip} {port}"
-                    elif extract_mode == "ip_only":
-                        result_item = extracted.split(':')[0]
-                    else:
-                        result_item = extracted
-                
-                if result_item and result_item not in seen:
-                    seen.add(result_item)
-                    results.append(result_item)
+            remark = split_remark(line)
+            if where and not where.match(ip, port, remark):
+                continue
             
-        results.sort()
-        return results
-        
-    except Exception as e:
-        print(f"❌ 处理文本文件失败: {e}")
-        return []
+            yield row, ip, port, remark
 
-def process_dataframe_for_quick_mode(df, extract_mode="ip_space_port", default_port=""):
-    """处理DataFrame数据用于快速模式"""
+def detect_frame_columns(df, extract_mode="ip_space_port"):
+    """自动检测表格的 IP列、端口列和备注列，返回 (IP列, IP列类型, 端口列, 备注列)，未找到IP列时IP列为None"""
     ip_col = None
     port_col = None
     ip_col_type = 'unknown'
@@ -380,30 +1113,70 @@ def process_dataframe_for_quick_mode(df, extract_mode="ip_space_port", default_p
         if col_type in ['ip_port', 'ip_only', 'mixed']:
             ip_col = col
             ip_col_type = col_type
-            print(f"📡 检测到IP列 '{col}' - 类型: {col_type}")
+            logger.info(f"📡 检测到IP列 '{col}' - 类型: {col_type}")
             break
         elif any(keyword in col_lower for keyword in ['ip', '地址', 'host', 'input']):
             ip_col = col
             ip_col_type = detect_column_content_type(sample_data)
-            print(f"📡 检测到IP列 '{col}' - 类型: {ip_col_type}")
+            logger.info(f"📡 检测到IP列 '{col}' - 类型: {ip_col_type}")
             break
     
     if not ip_col:
-        print("❌ 无法自动检测IP列")
-        return []
+        return None, ip_col_type, None, None
     
     # 检测端口列
     for col in df.columns:
         col_lower = str(col).lower()
         if any(keyword in col_lower for keyword in ['port', '端口']):
             port_col = col
-            print(f"🔌 检测到端口列: {col}")
+            logger.info(f"🔌 检测到端口列: {col}")
             break
     
-    results = []
-    seen = set()
+    # 检测备注列（列式文件回读时保留备注）
+    remark_col = None
+    if extract_mode in ["ip_port_remark", RECORD_MODE]:
+        for col in df.columns:
+            if str(col).lower() in ['remark', '备注']:
+                remark_col = col
+                break
     
-    for _, row in df.iterrows():
+    return ip_col, ip_col_type, port_col, remark_col
+
+def validate_frame(df, validator, columns=None):
+    """向量化校验表格的纯IP列或 IP:端口 列（及端口列）：去掉不合法的行，IP和端口替换为规范写法；混合内容的列不在此校验"""
+    ip_col, ip_col_type, port_col, _ = columns or detect_frame_columns(df)
+    if ip_col_type not in ['ip_only', 'ip_port']:
+        return df
+    df = df.copy()
+    if ip_col_type == 'ip_port':
+        values = df[ip_col].fillna('').astype(str).str.strip()
+        pairs = values.map({value: split_host_port(value) for value in values.unique()})
+        mask, ips, ports = validator.validate_series(pairs.str[0], pairs.str[1])
+        df[ip_col] = [join_ip_port(ip, port) if port else ip for ip, port in zip(ips, ports)]
+    else:
+        port_values = df[port_col] if port_col else None
+        mask, ips, ports = validator.validate_series(df[ip_col], port_values)
+        df[ip_col] = ips
+        if port_col:
+            df[port_col] = ports
+    return df[mask.values]
+
+def iter_frame_endpoints(df, extract_mode="ip_space_port", default_port="", validator=None, columns=None):
+    """逐行提取表格中的 (行号, IP, 端口, 备注)（生成器，不去重）；IP列内容无法识别时原样作为IP、端口为None
+    
+    columns: detect_frame_columns 的结果，分块读取时只在第一块检测一次；检测不到IP列时抛出 ValueError
+    """
+    ip_col, ip_col_type, port_col, remark_col = columns or detect_frame_columns(df, extract_mode)
+    if not ip_col:
+        raise ValueError("无法自动检测IP列")
+    
+    validator = EndpointValidator() if validator is None else validator
+    
+    # 纯IP列和 IP:端口 列整列向量化校验，替换为规范写法；混合内容在逐行提取后校验
+    df = validate_frame(df, validator, (ip_col, ip_col_type, port_col, remark_col))
+    
+    for row_index, row in df.iterrows():
+        remark = None
         try:
             ip_value = str(row[ip_col]).strip()
             if not ip_value:
@@ -411,85 +1184,89 @@ def process_dataframe_for_quick_mode(df, extract_mode="ip_space_port", default_p
                 
             # 处理IP列
             if ip_col_type == 'ip_port':
-                # 已经是IP:端口格式
-                if extract_mode == "ip_space_port":
-                    ip, port = ip_value.split(':')
-                    result_item = f"{ip} {port}"
-                elif extract_mode == "ip_only":
-                    result_item = ip_value.split(':')[0]
-                else:
-                    result_item = ip_value
+                # 已经是IP:端口格式（含 [IPv6]:端口）
+                ip, port = split_host_port(ip_value)
+                ip = normalize_ip(ip) or ip
             elif ip_col_type == 'mixed':
                 # 混合内容，尝试提取IP和端口
-                extracted = extract_ip_port_from_mixed(ip_value)
-                if extracted:
-                    if ':' not in extracted:
-                        if extract_mode == "ip_only":
-                            result_item = extracted
-                        elif default_port:
-                            if extract_mode == "ip_space_port":
-                                result_item = f"{extracted} {default_port}"
-                            else:
-                                result_item = f"{extracted}:{default_port}"
-                        else:
-                            continue  # 没有端口且没有默认端口，跳过
-                    else:
-                        if extract_mode == "ip_space_port":
-                            ip, port = extracted.split(':')
-                            result_item = f"{ip} {port}"
-                        elif extract_mode == "ip_only":
-                            result_item = extracted.split(':')[0]
-                        else:
-                            result_item = extracted
-                else:
+                ip, port = extract_ip_port_pair(ip_value)
+                if ip:
+                    ip, port = validator.check(ip, port)
+                if not ip:
                     continue
+                if not port:
+                    if port_required(extract_mode) and not default_port:
+                        continue  # 没有端口且没有默认端口，跳过
+                    port = default_port
             elif ip_col_type == 'ip_only':
                 # 纯IP
+                ip = normalize_ip(ip_value) or ip_value
                 if extract_mode == "ip_only":
-                    result_item = ip_value
-                elif port_col:
-                    port_value = str(row[port_col]).strip()
-                    if port_value and port_value.isdigit():
-                        if extract_mode == "ip_space_port":
-                            result_item = f"{ip_value} {port_value}"
-                        else:
-                            result_item = f"{ip_value}:{port_value}"
-                    elif default_port:
-                        if extract_mode == "ip_space_port":
-                            result_item = f"{ip_value} {default_port}"
-                        else:
-                            result_item = f"{ip_value}:{default_port}"
-                    else:
-                        continue  # 没有端口且没有默认端口，跳过
+                    port = None
+                elif port_col and str(row[port_col]).strip().isdigit():
+                    port = str(row[port_col]).strip()
+                    if remark_col is not None and pd.notna(row[remark_col]) and str(row[remark_col]).strip():
+                        remark = str(row[remark_col]).strip()
                 elif default_port:
-                    if extract_mode == "ip_space_port":
-                        result_item = f"{ip_value} {default_port}"
-                    else:
-                        result_item = f"{ip_value}:{default_port}"
+                    port = default_port
+                elif not port_required(extract_mode):
+                    port = None
                 else:
                     continue  # 没有端口且没有默认端口，跳过
             else:
-                result_item = ip_value
-                
-            if result_item and result_item not in seen:
-                seen.add(result_item)
-                results.append(result_item)
-                
+                ip, port = ip_value, None
         except Exception as e:
             continue
+        
+        yield row_index, ip, port, remark
+
+def read_source_frames(file_path, where=None, sheets=None):
+    """读取表格类输入（Excel/CSV/列式文件）为 {工作表名: DataFrame}，Excel 未指定工作表时读取全部工作表；读取失败时抛出异常"""
+    if os.path.splitext(file_path)[1].lower() in ['.xlsx', '.xls']:
+        return read_excel_frames(file_path, sheets or pd.ExcelFile(file_path).sheet_names, where)
+    df = read_columnar_file(file_path, where) if get_columnar_format(file_path) else read_csv_frame(file_path, where)
+    return {'': df}
+
+def iter_source_endpoints(source, extract_mode=RECORD_MODE, default_port="", where=None, validator=None, expand=None, sheets=None):
+    """逐条提取输入中的 (来源行号, IP, 端口, 备注)（生成器，不去重）
     
-    results.sort()
-    return results
+    文本输入的行号从0开始，表格输入为DataFrame的行索引（Excel 每个工作表各自从0开始）；
+    sheets 为None时读取Excel的全部工作表，不交互；文件无法读取或找不到IP列时抛出异常，进度信息通过 logger 输出
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        lines = source if expand is None else iter_expand_lines(source, expand.get('limit'), expand.get('sample'))
+        yield from iter_text_endpoints(lines, extract_mode, default_port, where, validator)
+        return
+    
+    file_path = os.fspath(source)
+    special = is_special_format_file(file_path)
+    if special or os.path.splitext(file_path)[1].lower() == '.txt':
+        logger.info("🔍 正在提取文件信息..." if special else "📝 正在从文本文件提取数据...")
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            if special:
+                yield from iter_special_endpoints(f, where, validator)
+            else:
+                yield from iter_source_endpoints(f, extract_mode, default_port, where, validator, expand)
+        return
+    
+    for df in read_source_frames(file_path, where, sheets).values():
+        yield from iter_frame_endpoints(df, extract_mode, default_port, validator)
 
-def quick_mode(file_path, extract_mode="ip_space_port", is_drag_drop=False):
+def quick_mode(file_path, extract_mode="ip_space_port", is_drag_drop=False, where=None, dedup_policy=None):
     """快速模式：支持多种输出格式"""
     print("=== 快速模式 ===")
     
+    # 非拖拽模式可设置过滤条件（文本类输入只支持 ip/port/remark 字段）
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if where is None and not is_drag_drop:
+        where = ask_where_filter(text_input=is_special_format_file(file_path) or file_ext == '.txt')
+    validator = EndpointValidator()
+    
     # 检测是否为特殊格式文件
     if is_special_format_file(file_path):
         if is_drag_drop:
             # 拖拽模式直接使用 IP:端口#备注 格式
-            results = extract_special_format(file_path)
+            extract_mode = "ip_port_remark"
             output_filename = "ip_port_remark_results"
             print("🔍 检测到特殊格式文件，使用 IP:端口#备注 格式输出")
         else:
@@ -498,32 +1275,22 @@ def quick_mode(file_path, extract_mode="ip_space_port", is_drag_drop=False):
             print("1. IP:端口#备注 格式")
             print("2. IP 空格 端口 格式")
             print("3. 仅IP模式")
+            print("4. CIDR 聚合")
             
-            choice = input("请选择(1/2/3, 默认1): ").strip()
-            if choice == "2":
-                special_results = extract_special_format(file_path)
-                results = []
-                for item in special_results:
-                    match = re.match(r'([^:]+):(\d+)(#.*)?', item)
-                    if match:
-                        results.append(f"{match.group(1)} {match.group(2)}")
-                extract_mode = "ip_space_port"
-                output_filename = "ip_port_results"
-            elif choice == "3":
-                special_results = extract_special_format(file_path)
-                results = []
-                for item in special_results:
-                    match = re.match(r'([^:]+):(\d+)(#.*)?', item)
-                    if match:
-                        results.append(match.group(1))
-                extract_mode = "ip_only"
-                output_filename = "ip_results"
-            else:
-                results = extract_special_format(file_path)
-                extract_mode = "ip_port_remark"
-                output_filename = "ip_port_remark_results"
+            choice = input("请选择(1/2/3/4, 默认1): ").strip()
+            extract_mode, output_filename = {
+                "2": ("ip_space_port", "ip_port_results"),
+                "3": ("ip_only", "ip_results"),
+                "4": ("cidr", "cidr_results"),
+            }.get(choice, ("ip_port_remark", "ip_port_remark_results"))
+        
+        # 链接中的端口都已给出，提取为规范记录后按所选模式格式化
+        try:
+            results = render_records(iter_records(file_path, RECORD_MODE, where=where, validator=validator), extract_mode)
+        except Exception as e:
+            print(f"❌ 处理文件失败: {e}")
+            results = []
     else:
-        file_ext = os.path.splitext(file_path)[1].lower()
         output_filename = "results"
         
         # 设置默认端口 - 只有需要端口的模式才询问
@@ -543,6 +1310,8 @@ def quick_mode(file_path, extract_mode="ip_space_port", is_drag_drop=False):
                 # 拖拽模式不添加默认端口
                 default_port = ""
                 print("✅ 拖拽模式：不添加默认端口，仅提取包含端口的数据")
+        elif extract_mode == "cidr":
+            print("✅ CIDR聚合模式：有端口时按端口分别聚合，无端口时只聚合IP")
         else:
             # 仅IP模式不需要端口
             print("✅ 仅IP模式：提取所有IP地址，不关心端口")
@@ -550,39 +1319,70 @@ def quick_mode(file_path, extract_mode="ip_space_port", is_drag_drop=False):
         # 处理不同类型文件
         if file_ext in ['.xlsx', '.xls']:
             print("说明：自动检测IP列，智能处理IP和端口")
-            dfs_dict = process_excel_file(file_path)
+            dfs_dict = process_excel_file(file_path, where=where)
             if not dfs_dict:
                 return
             
             all_results = []
             for sheet_name, df in dfs_dict.items():
                 print(f"\n📊 处理工作表: {sheet_name}")
-                sheet_results = process_dataframe_for_quick_mode(df, extract_mode, default_port)
+                try:
+                    endpoints = iter_frame_endpoints(df, extract_mode, default_port, validator)
+                    sheet_results = render_records(iter_endpoint_records(endpoints, extract_mode), extract_mode)
+                except ValueError as e:
+                    print(f"❌ {e}")
+                    continue
                 if sheet_results:
                     all_results.append(f"----- {sheet_name} -----")
                     all_results.extend(sheet_results)
             
             results = all_results
-            
-        elif file_ext in ['.txt']:
-            if extract_mode == "ip_only":
-                print("说明：从文本文件中只提取IP地址，自动去重排序")
-                output_filename = "ip_results"
-            elif extract_mode == "ip_port_remark":
-                print("说明：从文本文件中提取 IP:端口#备注 格式")
-                output_filename = "ip_port_remark_results"
-            else:
-                print("说明：从文本文件中提取 IP 空格 端口 格式")
-                output_filename = "ip_port_results"
+        else:
+            expand = None
+            if file_ext in ['.txt']:
+                if extract_mode == "ip_only":
+                    print("说明：从文本文件中只提取IP地址，自动去重排序")
+                    output_filename = "ip_results"
+                elif extract_mode == "ip_port_remark":
+                    print("说明：从文本文件中提取 IP:端口#备注 格式")
+                    output_filename = "ip_port_remark_results"
+                elif extract_mode == "cidr":
+                    print("说明：从文本文件中提取IP并聚合为最少的CIDR块")
+                    output_filename = "cidr_results"
+                else:
+                    print("说明：从文本文件中提取 IP 空格 端口 格式")
+                    output_filename = "ip_port_results"
                 
-            results = extract_from_text_advanced(file_path, extract_mode, default_port)
+                # 文件中包含CIDR/IP段时可展开为单个IP
+                if not is_drag_drop and has_ip_range_spec(file_path):
+                    if input("🔧 检测到CIDR/IP段，是否展开为单个IP？(y/n, 默认n): ").strip().lower() == 'y':
+                        limit = input("展开上限(直接回车不限制): ").strip()
+                        sample = input("每个地址段随机抽样数量(直接回车全部展开): ").strip()
+                        expand = {'limit': int(limit) if limit.isdigit() else None,
+                                  'sample': int(sample) if sample.isdigit() else None}
+            else:  # CSV、列式文件和其他格式
+                print("说明：自动检测IP列，智能处理IP和端口")
             
-        else:  # CSV和其他格式
-            print("说明：自动检测IP列，智能处理IP和端口")
-            df = process_csv_file(file_path)
-            if df is None:
-                return
-            results = process_dataframe_for_quick_mode(df, extract_mode, default_port)
+            try:
+                records = iter_records(file_path, extract_mode, default_port, where, validator=validator, expand=expand)
+                results = render_records(records, extract_mode)
+            except Exception as e:
+                print(f"❌ 处理文件失败: {e}")
+                results = []
+    
+    print_validation_summary(validator)
+    if where:
+        print(f"🔎 过滤条件排除了 {where.rejected} 条记录")
+    
+    # 带备注输出时可按 IP+端口 去重，避免同一端点因指标不同重复出现
+    if dedup_policy is None and not is_drag_drop and extract_mode == "ip_port_remark" and results:
+        if input("🔄 是否按 IP+端口 去重，每个端点只保留一行? (y/n, 默认n): ").strip().lower() == 'y':
+            dedup_policy = ask_dedup_policy("(比较备注中的延迟/速度)")
+    if dedup_policy and results:
+        results = dedup_lines_by_endpoint(results, dedup_policy)
+    
+    if extract_mode == "cidr" and results:
+        results = collapse_results_to_cidr(results)
     
     if not results or (len(results) == 1 and results[0].startswith('-----')):
         print("❌ 未提取到任何有效数据")
@@ -600,9 +1400,7 @@ def quick_mode(file_path, extract_mode="ip_space_port", is_drag_drop=False):
     output_path = get_safe_output_path(output_file)
     
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for line in results:
-                f.write(line + '\n')
+        write_results_file(results, output_path)
         
         valid_count = len([line for line in results if not line.startswith('-----')])
         print(f"✅ 处理完成！共生成 {valid_count} 条去重记录")
@@ -623,8 +1421,914 @@ def quick_mode(file_path, extract_mode="ip_space_port", is_drag_drop=False):
     if is_drag_drop:
         input("\n⏹️  按回车键退出...")
 
-def truncate_format(format_template, max_columns):
-    """根据最大列数截断格式"""
+# 指标单位换算：时间统一为毫秒，速度统一为 字节/秒
+METRIC_UNITS = {
+    'ms': 1, 's': 1000, 'us': 0.001, 'μs': 0.001,
+    'b/s': 1, 'kb/s': 1024, 'mb/s': 1024 ** 2, 'gb/s': 1024 ** 3,
+    'bps': 1 / 8, 'kbps': 1000 / 8, 'mbps': 1000 ** 2 / 8, 'gbps': 1000 ** 3 / 8,
+    '%': 1,
+}
+METRIC_RE = re.compile(r'^\s*([-+]?\d+(?:\.\d+)?)\s*([a-zμ%/]*)\s*$', re.IGNORECASE)
+
+def parse_metric_value(value):
+    """解析带单位的指标（如 20ms、1.5MB/s、12.3 Mbps）为数值，无法解析返回None"""
+    match = METRIC_RE.match(str(value))
+    if not match:
+        return None
+    unit = match.group(2).lower()
+    if unit and unit not in METRIC_UNITS:
+        return None
+    return float(match.group(1)) * METRIC_UNITS.get(unit, 1)
+
+def metric_prefers_larger(sample_value):
+    """根据单位判断指标是否越大越好（速度类），延迟等默认越小越好"""
+    text = str(sample_value).lower()
+    return '/s' in text or 'bps' in text
+
+def select_top_k(items, k, metric_func, largest=False, group_func=None):
+    """流式选出最优的K项（可按组），每组用大小为K的堆，内存O(K)、时间O(N log K)
+    
+    返回 (结果列表, 无法解析指标而跳过的数量)，结果按组排列，组内从优到差
+    """
+    heaps = {}
+    skipped = 0
+    for seq, item in enumerate(items):
+        value = metric_func(item)
+        if value is None:
+            skipped += 1
+            continue
+        # 堆顶始终是当前组内最差的一项；同值时先出现的优先保留
+        entry = ((value if largest else -value), -seq, item)
+        heap = heaps.setdefault(group_func(item) if group_func else None, [])
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    
+    results = []
+    for group in sorted(heaps, key=lambda g: str(g)):
+        results.extend(entry[2] for entry in sorted(heaps[group], reverse=True))
+    return results, skipped
+
+# 排序列类型；超过阈值的行数改用 NumPy lexsort
+SORT_TYPES = ['ip', 'int', 'float', 'text']
+LEXSORT_THRESHOLD = 100000
+
+def parse_sort_spec(spec, column_count):
+    """解析排序规则，如 "4:asc:float,1:asc:ip"，返回 [(列下标, 是否降序, 类型)]，类型省略时为None
+    
+    只写数字（如 "4"）等同于按该列升序、自动推断类型
+    """
+    sort_keys = []
+    for part in spec.split(','):
+        fields = [field.strip().lower() for field in part.strip().split(':')]
+        if not fields[0].isdigit() or not 1 <= int(fields[0]) <= column_count:
+            raise ValueError(f"无效的排序列: {part.strip()}")
+        order = fields[1] if len(fields) > 1 and fields[1] else 'asc'
+        if order not in ['asc', 'desc']:
+            raise ValueError(f"无效的排序方向: {order}（应为 asc/desc）")
+        sort_type = fields[2] if len(fields) > 2 and fields[2] else None
+        if sort_type is not None and sort_type not in SORT_TYPES:
+            raise ValueError(f"无效的排序类型: {sort_type}（应为 {'/'.join(SORT_TYPES)}）")
+        sort_keys.append((int(fields[0]) - 1, order == 'desc', sort_type))
+    return sort_keys
+
+def infer_sort_type(values):
+    """根据样本值推断排序类型: ip / int / float / text"""
+    samples = [value for value in values if value][:50]
+    if not samples:
+        return 'text'
+    if all(normalize_ip(value) for value in samples):
+        return 'ip'
+    if all(value.isdigit() for value in samples):
+        return 'int'
+    if all(parse_metric_value(value) is not None for value in samples):
+        return 'float'
+    return 'text'
+
+def build_sort_keys(values, sort_type, descending):
+    """为一列预先计算紧凑的排序键（每行只计算一次），无法解析的值始终排在最后"""
+    if sort_type == 'ip':
+        keys = [ip_sort_key(value) for value in values]
+        if descending:
+            keys = [(rank, -number, text) for rank, number, text in keys]
+        return keys
+    if sort_type in ['int', 'float']:
+        numbers = [parse_metric_value(value) for value in values]
+        return [(1, 0.0) if number is None else (0, -number if descending else number) for number in numbers]
+    return values
+
+def build_lexsort_columns(values, sort_type, descending):
+    """将一列转换为 NumPy 键数组（可能多个，按重要性从高到低）"""
+    if sort_type in ['int', 'float']:
+        numbers = np.array([parse_metric_value(value) for value in values], dtype=float)
+        if descending:
+            numbers = -numbers
+        return [np.where(np.isnan(numbers), np.inf, numbers)]
+    if sort_type == 'ip':
+        # IP拆为 (类别, 高64位, 低64位)：IPv4 < IPv6 < 非IP，降序时数值取反
+        kinds = np.empty(len(values), dtype=np.int8)
+        high = np.zeros(len(values), dtype=np.uint64)
+        low = np.zeros(len(values), dtype=np.uint64)
+        for i, value in enumerate(values):
+            number = ip_to_int(value)
+            if number is None:
+                kinds[i] = 2
+            else:
+                kinds[i] = 1 if ':' in value else 0
+                high[i] = number >> 64
+                low[i] = number & 0xFFFFFFFFFFFFFFFF
+        if descending:
+            kinds = np.where(kinds == 2, 2, 1 - kinds).astype(np.int8)
+            high, low = ~high, ~low
+        text_rank = np.unique(np.where(kinds == 2, np.array(values, dtype=str), ''), return_inverse=True)[1]
+        return [kinds, high, low, text_rank]
+    ranks = np.unique(np.array(values, dtype=str), return_inverse=True)[1].astype(np.int64)
+    return [-ranks if descending else ranks]
+
+def sort_by_spec(items, sort_keys, values_func):
+    """按多列类型化规则对 items 稳定排序，values_func(item) 返回该项各列的值
+    
+    行数较少时对预计算的键做多轮稳定排序；行数超过 LEXSORT_THRESHOLD 时使用 NumPy lexsort
+    """
+    if not items or not sort_keys:
+        return items
+    columns = list(zip(*[values_func(item) for item in items]))
+    resolved = [(index, descending, sort_type or infer_sort_type(columns[index]))
+                for index, descending, sort_type in sort_keys]
+    
+    if len(items) > LEXSORT_THRESHOLD:
+        key_arrays = []
+        for index, descending, sort_type in resolved:
+            key_arrays.extend(build_lexsort_columns(columns[index], sort_type, descending))
+        # lexsort 以最后一个数组为主键
+        order = np.lexsort(key_arrays[::-1])
+    else:
+        # 从最次要的键开始逐轮稳定排序，等价于多键排序
+        order = list(range(len(items)))
+        for index, descending, sort_type in reversed(resolved):
+            keys = build_sort_keys(columns[index], sort_type, descending)
+            order.sort(key=keys.__getitem__, reverse=descending and sort_type == 'text')
+    return [items[i] for i in order]
+
+def describe_sort_spec(sort_keys):
+    """排序规则的可读描述"""
+    return ", ".join(f"第{index + 1}列{'降序' if descending else '升序'}({sort_type or '自动'})"
+                     for index, descending, sort_type in sort_keys)
+
+# ---- 离线IP段注释（国家/ASN/colo 等）----
+# 数据库为CSV：network(CIDR) 列，或 start/end 两列（IP或整数），其余列为注释字段
+# 首次使用时编译为 <数据库>.idx 目录（按起始地址排序的 .npy 数组），之后以内存映射方式直接加载
+# 重叠的地址段在编译时拆成互不重叠的段，每段取覆盖它的最窄地址段的注释
+ANNOTATION_RANGE_COLUMNS = {
+    'network': ['network', 'cidr', 'prefix', 'range'],
+    'start': ['start', 'start_ip', 'ip_start', 'ip_from', 'first', 'from'],
+    'end': ['end', 'end_ip', 'ip_end', 'ip_to', 'last', 'to'],
+}
+ANNOTATION_INDEX_SUFFIX = '.idx'
+ANNOTATION_INDEX_FORMAT = 2     # 索引格式版本，旧版本编译的索引（未拆分重叠段）需要重新编译
+ANNOTATION_INDEXES = {}
+
+def parse_range_bound(value):
+    """解析地址段边界：IP文本或整数，返回 (版本, 整数值)"""
+    text = str(value).strip()
+    if text.isdigit():
+        number = int(text)
+        return (4 if number < (1 << 32) else 6), number
+    address = parse_ip_address(text)
+    if address is None:
+        raise ValueError(f"无法解析的地址: {text}")
+    return address.version, int(address)
+
+def ipv6_key(value):
+    """IPv6 整数转为16字节大端序，按字节比较即按数值比较"""
+    return value.to_bytes(16, 'big')
+
+def flatten_ranges(items):
+    """将可能重叠的地址段 (起始, 结束, 行号) 拆成互不重叠的段，每段取覆盖它的最窄地址段（同宽取靠后的行）"""
+    items = sorted(items)
+    bounds = sorted({start for start, _, _ in items} | {end + 1 for _, end, _ in items})
+    active = []  # 堆: (宽度, -行号, 结束, 行号)，已结束的段在到达堆顶时才移除
+    segments = []
+    i = 0
+    for bound, next_bound in zip(bounds, bounds[1:]):
+        while i < len(items) and items[i][0] == bound:
+            start, end, row = items[i]
+            heapq.heappush(active, (end - start, -row, end, row))
+            i += 1
+        while active and active[0][2] < bound:
+            heapq.heappop(active)
+        if not active:
+            continue
+        row = active[0][3]
+        if segments and segments[-1][2] == row and segments[-1][1] == bound - 1:
+            segments[-1] = (segments[-1][0], next_bound - 1, row)
+        else:
+            segments.append((bound, next_bound - 1, row))
+    return segments
+
+class AnnotationIndex:
+    """IP段注释索引：IPv4 为 uint32 起止数组，IPv6 为16字节起止数组，按起始地址排序后二分查找"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != ANNOTATION_INDEX_FORMAT:
+            logger.warning(f"⚠️  注释索引 {directory} 由旧版本编译，重叠地址段的注释可能不正确，请删除后用CSV数据库重新编译")
+        self.fields = self.meta['fields']
+        self.labels = self.meta['labels']
+        self.tables = {}
+        for family in ['v4', 'v6']:
+            self.tables[family] = tuple(
+                np.load(os.path.join(directory, f"{family}_{name}.npy"), mmap_mode='r')
+                for name in ['start', 'end', 'codes']
+            )
+    
+    def __reduce__(self):
+        # 传给并行工作进程时只传索引目录，由子进程重新内存映射加载
+        return AnnotationIndex, (self.directory,)
+    
+    @staticmethod
+    def compile(source, directory):
+        """将CSV地址段数据库编译为索引目录"""
+        df = pd.read_csv(source, dtype=str, keep_default_na=False)
+        lower = {str(col).strip().lower(): col for col in df.columns}
+        found = {role: next((lower[name] for name in names if name in lower), None)
+                 for role, names in ANNOTATION_RANGE_COLUMNS.items()}
+        if found['network'] is not None:
+            range_columns = [found['network']]
+        elif found['start'] is not None and found['end'] is not None:
+            range_columns = [found['start'], found['end']]
+        else:
+            raise ValueError("数据库需要 network(CIDR) 列，或 start/end 两列")
+        fields = [str(col) for col in df.columns if col not in range_columns]
+        
+        # 注释值按字段编码为整数，标签表存入 meta.json
+        labels = {field: sorted(set(df[field])) for field in fields}
+        codes = np.column_stack([
+            df[field].map({label: i for i, label in enumerate(labels[field])}).to_numpy(dtype=np.int32)
+            for field in fields
+        ]) if fields else np.zeros((len(df), 0), dtype=np.int32)
+        
+        ranges = {'v4': [], 'v6': []}
+        for row, values in enumerate(df[range_columns].itertuples(index=False)):
+            if len(range_columns) == 1:
+                network = ipaddress.ip_network(str(values[0]).strip(), strict=False)
+                version, start, end = network.version, int(network.network_address), int(network.broadcast_address)
+            else:
+                version, start = parse_range_bound(values[0])
+                end_version, end = parse_range_bound(values[1])
+                if end_version != version or end < start:
+                    raise ValueError(f"第{row + 2}行地址段无效: {values[0]} - {values[1]}")
+            ranges['v4' if version == 4 else 'v6'].append((start, end, row))
+        
+        os.makedirs(directory, exist_ok=True)
+        overlaps = 0
+        for family, items in ranges.items():
+            items.sort()
+            overlaps += sum(1 for previous, current in zip(items, items[1:]) if current[0] <= previous[1])
+            items = flatten_ranges(items)
+            if family == 'v4':
+                starts = np.array([item[0] for item in items], dtype=np.uint32)
+                ends = np.array([item[1] for item in items], dtype=np.uint32)
+            else:
+                starts = np.array([ipv6_key(item[0]) for item in items], dtype='S16')
+                ends = np.array([ipv6_key(item[1]) for item in items], dtype='S16')
+            np.save(os.path.join(directory, f"{family}_start.npy"), starts)
+            np.save(os.path.join(directory, f"{family}_end.npy"), ends)
+            np.save(os.path.join(directory, f"{family}_codes.npy"), codes[[item[2] for item in items]].reshape(len(items), len(fields)))
+        
+        stat = os.stat(source)
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'format': ANNOTATION_INDEX_FORMAT, 'source_size': stat.st_size, 'source_mtime': stat.st_mtime,
+                       'fields': fields, 'labels': labels}, f, ensure_ascii=False)
+        if overlaps:
+            logger.warning(f"⚠️  数据库中有 {overlaps} 处地址段重叠，重叠部分取最窄（最具体）的地址段")
+        logger.info(f"✅ 已编译注释索引: IPv4 {len(ranges['v4'])} 段，IPv6 {len(ranges['v6'])} 段，字段: {', '.join(fields)}")
+    
+    @classmethod
+    def load(cls, source):
+        """加载索引：source 为编译好的 .idx 目录，或CSV数据库（索引缺失或过期时自动重新编译）"""
+        if os.path.isdir(source):
+            return cls(source)
+        directory = source + ANNOTATION_INDEX_SUFFIX
+        meta_path = os.path.join(directory, 'meta.json')
+        stat = os.stat(source)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if (meta.get('format') == ANNOTATION_INDEX_FORMAT and meta.get('source_size') == stat.st_size
+                    and meta.get('source_mtime') == stat.st_mtime):
+                return cls(directory)
+        logger.info(f"🔨 正在编译注释索引: {source}")
+        cls.compile(source, directory)
+        return cls(directory)
+    
+    def field_name(self, field):
+        """按名称（不区分大小写）查找注释字段，不存在返回None"""
+        return next((name for name in self.fields if name.lower() == str(field).lower()), None)
+    
+    def lookup_codes(self, ips):
+        """批量查找：返回每个IP命中地址段的注释编码矩阵，未命中的行为 -1"""
+        result = np.full((len(ips), len(self.fields)), -1, dtype=np.int32)
+        v4_rows, v4_keys, v6_rows, v6_keys = [], [], [], []
+        for row, ip in enumerate(ips):
+            value = ip_to_int(ip) if ip else None
+            if value is None:
+                continue
+            if ':' in str(ip):
+                v6_rows.append(row)
+                v6_keys.append(ipv6_key(value))
+            else:
+                v4_rows.append(row)
+                v4_keys.append(value)
+        for family, rows, keys, dtype in [('v4', v4_rows, v4_keys, np.uint32), ('v6', v6_rows, v6_keys, 'S16')]:
+            starts, ends, codes = self.tables[family]
+            if not rows or len(starts) == 0:
+                continue
+            keys = np.array(keys, dtype=dtype)
+            index = np.searchsorted(starts, keys, side='right') - 1
+            hit = (index >= 0) & (ends[np.maximum(index, 0)] >= keys)
+            result[np.array(rows)[hit]] = codes[index[hit]]
+        return result
+    
+    def lookup_batch(self, ips):
+        """批量查找注释，返回 {字段: 标签列表}，未命中为空字符串"""
+        codes = self.lookup_codes(list(ips))
+        return {
+            field: [self.labels[field][code] if code >= 0 else '' for code in codes[:, i]]
+            for i, field in enumerate(self.fields)
+        }
+    
+    def lookup(self, ip):
+        """查找单个IP的注释 {字段: 标签}"""
+        return {field: labels[0] for field, labels in self.lookup_batch([ip]).items()}
+    
+    def annotate_frame(self, df, ip_column):
+        """为DataFrame追加注释列（IP列中的不同取值只查找一次）"""
+        values = df[ip_column].fillna('').astype(str)
+        unique = values.unique()
+        ips = [extract_ip_port_pair(value)[0] or '' for value in unique]
+        annotations = self.lookup_batch(ips)
+        df = df.copy()
+        for field in self.fields:
+            column = field if field not in df.columns else f"{field}_注释"
+            df[column] = values.map(dict(zip(unique, annotations[field])))
+        return df
+
+def load_annotation_index(source):
+    """加载注释索引（同一数据库在一次运行中只加载一次）"""
+    key = os.path.abspath(source)
+    if key not in ANNOTATION_INDEXES:
+        ANNOTATION_INDEXES[key] = AnnotationIndex.load(source)
+    return ANNOTATION_INDEXES[key]
+
+def render_tag(tag_template, annotation):
+    """用注释填充标签模板，如 [country]-[asn]"""
+    result = tag_template
+    for field, value in annotation.items():
+        result = result.replace(f"[{field}]", value)
+    return result.strip()
+
+# ---- 过滤表达式（--where）----
+# 语法: 字段 运算符 值，用 and / or / not 和括号组合
+#   运算符: = == != < <= > >= ~(正则包含) in (...) / not in (...)
+#   关键字: private / bogon / ipv4 / ipv6（作用于IP字段）
+#   示例: port in (443,2053,8443) and 延迟 < 150 and 地区 in (HK,JP,SG) and not bogon
+WHERE_TOKEN_RE = re.compile(r'\s*(?:(<=|>=|!=|==|=|<|>|~)|([(),])|"([^"]*)"|\'([^\']*)\'|([^\s()<>=!~,"\']+))')
+WHERE_KEYWORDS = {
+    'private': is_private_ip,
+    'bogon': is_bogon_ip,
+    'ipv4': lambda ip: ip_to_int(ip) is not None and ':' not in ip,
+    'ipv6': lambda ip: ip_to_int(ip) is not None and ':' in ip,
+}
+# 文本输入中可用的字段
+TEXT_WHERE_FIELDS = ['ip', 'port', 'remark']
+CSV_CHUNK_SIZE = 100000
+
+class WhereError(ValueError):
+    """过滤表达式错误"""
+
+def metric_series(series):
+    """向量化解析带单位的指标列，无法解析的值为NaN"""
+    parts = series.astype(str).str.extract(r'^\s*([-+]?\d+(?:\.\d+)?)\s*([a-zA-Zμ%/]*)\s*$')
+    factors = parts[1].fillna('').str.lower().map(lambda unit: 1 if unit == '' else METRIC_UNITS.get(unit))
+    return pd.to_numeric(parts[0], errors='coerce') * pd.to_numeric(factors, errors='coerce')
+
+def compile_predicate(field, op, operands):
+    """编译单个比较条件，返回 (记录判断函数, DataFrame掩码函数)"""
+    numbers = [parse_metric_value(value) for value in operands]
+    numeric = all(number is not None for number in numbers)
+    texts = [value.strip().lower() for value in operands]
+    
+    if op == '~':
+        pattern = re.compile(operands[0], re.IGNORECASE)
+        def match_record(get):
+            return bool(pattern.search(get(field)))
+        def match_frame(get):
+            return get(field).str.contains(pattern, na=False)
+        return match_record, match_frame
+    
+    if op in ['in', 'not in']:
+        negate = op == 'not in'
+        def match_record(get):
+            value = get(field)
+            found = parse_metric_value(value) in numbers if numeric else value.strip().lower() in texts
+            return found != negate
+        def match_frame(get):
+            found = metric_series(get(field)).isin(numbers) if numeric else get(field).str.strip().str.lower().isin(texts)
+            return ~found if negate else found
+        return match_record, match_frame
+    
+    compare = {
+        '=': lambda a, b: a == b, '==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+    }[op]
+    if numeric:
+        number = numbers[0]
+        def match_record(get):
+            value = parse_metric_value(get(field))
+            return value is not None and compare(value, number)
+        def match_frame(get):
+            values = metric_series(get(field))
+            return values.notna() & compare(values, number)
+    else:
+        text = texts[0]
+        def match_record(get):
+            return compare(get(field).strip().lower(), text)
+        def match_frame(get):
+            return compare(get(field).str.strip().str.lower(), text)
+    return match_record, match_frame
+
+class WhereFilter:
+    """编译后的过滤表达式：可逐条判断记录，也可向量化过滤DataFrame"""
+    
+    def __init__(self, expression):
+        self.expression = expression
+        self.fields = set()
+        self.rejected = 0
+        self.annotations = None  # 注释索引：设置后可按注释字段（如 country、asn）过滤
+        self.tokens = self.tokenize(expression)
+        self.position = 0
+        self.match_record, self.match_frame = self.parse_or()
+        if self.position != len(self.tokens):
+            raise WhereError(f"无法解析过滤条件: {' '.join(self.tokens[self.position:])}")
+    
+    @staticmethod
+    def tokenize(expression):
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = WHERE_TOKEN_RE.match(expression, position)
+            if not match or match.end() == position:
+                raise WhereError(f"过滤条件语法错误: {expression[position:]}")
+            tokens.append(next(group for group in match.groups() if group is not None))
+            position = match.end()
+        return tokens
+    
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index].lower() if index < len(self.tokens) else None
+    
+    def take(self):
+        if self.position >= len(self.tokens):
+            raise WhereError("过滤条件不完整")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+    
+    def parse_or(self):
+        left_record, left_frame = self.parse_and()
+        while self.peek() == 'or':
+            self.take()
+            right_record, right_frame = self.parse_and()
+            left_record = (lambda a, b: lambda get: a(get) or b(get))(left_record, right_record)
+            left_frame = (lambda a, b: lambda get: a(get) | b(get))(left_frame, right_frame)
+        return left_record, left_frame
+    
+    def parse_and(self):
+        left_record, left_frame = self.parse_not()
+        while self.peek() == 'and':
+            self.take()
+            right_record, right_frame = self.parse_not()
+            left_record = (lambda a, b: lambda get: a(get) and b(get))(left_record, right_record)
+            left_frame = (lambda a, b: lambda get: a(get) & b(get))(left_frame, right_frame)
+        return left_record, left_frame
+    
+    def parse_not(self):
+        if self.peek() == 'not':
+            self.take()
+            inner_record, inner_frame = self.parse_not()
+            return (lambda get: not inner_record(get)), (lambda get: ~inner_frame(get))
+        return self.parse_atom()
+    
+    def parse_atom(self):
+        token = self.take()
+        if token == '(':
+            result = self.parse_or()
+            if self.take() != ')':
+                raise WhereError("括号不匹配")
+            return result
+        
+        # 关键字条件作用于IP字段
+        if token.lower() in WHERE_KEYWORDS and self.peek() not in ['=', '==', '!=', '<', '<=', '>', '>=', '~', 'in', 'not']:
+            check = WHERE_KEYWORDS[token.lower()]
+            self.fields.add('ip')
+            def match_record(get):
+                return check(get('ip'))
+            def match_frame(get):
+                values = get('ip')
+                lookup = {value: check(value) for value in values.unique()}
+                return values.map(lookup).astype(bool)
+            return match_record, match_frame
+        
+        field = token
+        self.fields.add(field)
+        op = self.take().lower()
+        if op == 'not' and self.peek() == 'in':
+            self.take()
+            op = 'not in'
+        if op in ['in', 'not in']:
+            if self.take() != '(':
+                raise WhereError(f"{op} 后应为括号列表")
+            operands = []
+            while True:
+                operands.append(self.take())
+                separator = self.take()
+                if separator == ')':
+                    break
+                if separator != ',':
+                    raise WhereError("列表应使用逗号分隔")
+            return compile_predicate(field, op, operands)
+        if op not in ['=', '==', '!=', '<', '<=', '>', '>=', '~']:
+            raise WhereError(f"未知的运算符: {op}")
+        return compile_predicate(field, op, [self.take()])
+    
+    def check_text_fields(self):
+        """文本输入只有 ip/port/remark 字段（设置了注释索引时还可使用注释字段）"""
+        unknown = [field for field in self.fields if field.lower() not in TEXT_WHERE_FIELDS
+                   and not (self.annotations and self.annotations.field_name(field))]
+        if unknown:
+            allowed = TEXT_WHERE_FIELDS + (self.annotations.fields if self.annotations else [])
+            raise WhereError(f"文本输入仅支持 {'/'.join(allowed)} 字段，无法使用: {', '.join(unknown)}")
+    
+    def match(self, ip, port=None, remark=None):
+        """判断一条记录是否保留"""
+        values = {'ip': ip or '', 'port': port or '', 'remark': remark or ''}
+        def get(field):
+            field = field.lower()
+            if field not in values and self.annotations and self.annotations.field_name(field):
+                values.update({name.lower(): label for name, label in self.annotations.lookup(ip or '').items()})
+            return values.get(field, '')
+        keep = self.match_record(get)
+        if not keep:
+            self.rejected += 1
+        return keep
+    
+    def filter_frame(self, df):
+        """向量化过滤DataFrame（字段按列名、[列号] 或 ip/port/remark 别名匹配）"""
+        if df is None or len(df) == 0:
+            return df
+        cache = {}
+        def get(field):
+            if field not in cache:
+                annotation_field = self.annotations.field_name(field) if self.annotations else None
+                if annotation_field and not any(str(col).lower() == field.lower() for col in df.columns):
+                    # 注释字段：按IP列批量查找
+                    cache[field] = pd.Series(self.annotations.lookup_batch(get('ip'))[annotation_field], index=df.index)
+                    return cache[field]
+                column = resolve_filter_column(df, field)
+                series = df[column].fillna('').astype(str)
+                if field.lower() == 'ip':
+                    # IP字段统一提取为规范IP，便于 private/bogon 等判断
+                    lookup = {value: (extract_ip_port_pair(value)[0] or '') for value in series.unique()}
+                    series = series.map(lookup)
+                cache[field] = series
+            return cache[field]
+        mask = self.match_frame(get)
+        self.rejected += int((~mask).sum())
+        return df[mask.values]
+
+def resolve_filter_column(df, field):
+    """将过滤字段解析为DataFrame列名"""
+    columns = list(df.columns)
+    name = field.strip('[]')
+    if name.isdigit() and 1 <= int(name) <= len(columns):
+        return columns[int(name) - 1]
+    for col in columns:
+        if str(col).lower() == field.lower():
+            return col
+    
+    keywords = {'ip': ['ip', '地址', 'host'], 'port': ['port', '端口'], 'remark': ['remark', '备注']}.get(field.lower())
+    if field.lower() == 'ip':
+        # 优先按内容识别IP列
+        for col in columns:
+            if detect_column_content_type(df[col].dropna().head(10).tolist()) in ['ip_port', 'ip_only', 'mixed']:
+                return col
+    if keywords:
+        for col in columns:
+            if any(keyword in str(col).lower() for keyword in keywords):
+                return col
+    
+    matches = [col for col in columns if field.lower() in str(col).lower()]
+    if len(matches) == 1:
+        return matches[0]
+    raise WhereError(f"找不到过滤字段: {field}（可用列: {', '.join(str(col) for col in columns)}）")
+
+def compile_where(expression):
+    """编译过滤表达式，空表达式返回None"""
+    if not expression or not expression.strip():
+        return None
+    return WhereFilter(expression)
+
+def split_remark(line):
+    """取出文本行中 # 之后的备注"""
+    return line.split('#', 1)[1].strip() if '#' in line else ''
+
+def ask_where_filter(text_input=False):
+    """交互输入过滤条件，返回编译后的过滤器，直接回车返回None"""
+    while True:
+        expression = input("🔎 过滤条件(直接回车不过滤，如 port in (443,8443) and not bogon): ").strip()
+        try:
+            where = compile_where(expression)
+            if where and text_input:
+                where.check_text_fields()
+            return where
+        except WhereError as e:
+            print(f"❌ {e}，请重新输入")
+
+# 按键去重时的保留策略
+DEDUP_POLICIES = ['first', 'last', 'min', 'max']
+
+def pack_ip_port(ip, port):
+    """将 IP+端口 打包为紧凑整数键（IPv4/IPv6 不会冲突），非IP主机返回 (主机, 端口)"""
+    value = ip_to_int(ip) if ip else None
+    if value is None:
+        return (str(ip), str(port or ''))
+    if ':' in str(ip):
+        value |= 1 << 128
+    return (value << 17) | (int(port) + 1 if port and str(port).isdigit() and int(port) <= 65535 else 0)
+
+def compact_key_part(value):
+    """去重键中的单个值：IP和数字转为整数，其余保留文本"""
+    value = str(value).strip()
+    number = ip_to_int(value)
+    if number is not None:
+        return (1 << 130) | ((1 << 128) if ':' in value else 0) | number
+    if value.isdigit():
+        return int(value)
+    return value
+
+def dedup_by_key(items, key_func, policy='first', metric_func=None):
+    """按键去重，单次流式遍历：键 → 当前最优行下标的哈希表
+    
+    policy: first 保留第一条 / last 保留最后一条 / min、max 保留指标最小、最大的一条（指标无法解析视为最差）
+    返回保留的行，保持每个键首次出现的位置
+    """
+    best_index = {}
+    rows = []
+    metrics = []
+    for item in items:
+        key = key_func(item)
+        index = best_index.get(key)
+        metric = metric_func(item) if policy in ['min', 'max'] else None
+        if index is None:
+            best_index[key] = len(rows)
+            rows.append(item)
+            metrics.append(metric)
+        elif policy == 'last':
+            rows[index] = item
+        elif policy in ['min', 'max'] and metric is not None:
+            current = metrics[index]
+            if current is None or (metric < current if policy == 'min' else metric > current):
+                rows[index] = item
+                metrics[index] = metric
+    return rows
+
+# ---- 近似去重（布隆过滤器 + HyperLogLog）----
+# 用于无界输入流或超大文件：内存固定，代价是极少量记录可能被误判为重复而丢弃
+class BloomFilter:
+    """定长布隆过滤器（双重哈希生成 k 个位置）"""
+    
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def positions(self, h1, h2):
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+    
+    def contains(self, h1, h2):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(h1, h2))
+    
+    def add(self, h1, h2):
+        for p in self.positions(h1, h2):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+class ScalableBloomFilter:
+    """可扩展布隆过滤器：写满后追加容量翻倍、误判率减半的新层，总误判率约为设定值；达到内存预算后停止扩容"""
+    
+    def __init__(self, error_rate=0.001, memory_budget=64 * 1024 * 1024, initial_capacity=1 << 20):
+        self.error_rate = error_rate
+        self.memory_budget = memory_budget
+        # 首层不超过预算的一半，给后续扩容留出空间
+        bits_per_item = -math.log(error_rate / 2) / (math.log(2) ** 2)
+        initial_capacity = max(1024, min(initial_capacity, int(memory_budget * 8 / 2 / bits_per_item)))
+        self.layers = [BloomFilter(initial_capacity, error_rate / 2)]
+        self.saturated = False
+    
+    @property
+    def memory_bytes(self):
+        return sum(len(layer.bits) for layer in self.layers)
+    
+    def contains(self, h1, h2):
+        return any(layer.contains(h1, h2) for layer in self.layers)
+    
+    def add(self, h1, h2):
+        layer = self.layers[-1]
+        if layer.count >= layer.capacity and not self.saturated:
+            capacity = layer.capacity * 2
+            error_rate = self.error_rate / (2 ** (len(self.layers) + 1))
+            bytes_needed = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) // 8
+            if self.memory_bytes + bytes_needed <= self.memory_budget:
+                layer = BloomFilter(capacity, error_rate)
+                self.layers.append(layer)
+            else:
+                # 内存预算用尽：继续写入最后一层，误判率会逐渐升高
+                self.saturated = True
+                print(f"⚠️  近似去重已达到内存预算 {self.memory_budget // (1024 * 1024)}MB，误判率将逐渐升高")
+        layer.add(h1, h2)
+
+class HyperLogLog:
+    """HyperLogLog 基数估计（2^precision 个寄存器，标准误差约 1.04/sqrt(寄存器数)）"""
+    
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+    
+    def add_hash(self, value):
+        """加入一个64位哈希值"""
+        index = value >> (64 - self.precision)
+        remaining = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            return int(m * math.log(m / zeros))
+        return int(raw)
+
+class ApproxSeenSet:
+    """近似去重集合：用法与 set 相同（in / add），按打包的 IP+端口 判重，同时用 HyperLogLog 估计不同记录数"""
+    
+    def __init__(self, error_rate=0.001, memory_mb=64):
+        self.bloom = ScalableBloomFilter(error_rate, memory_mb * 1024 * 1024)
+        self.hll = HyperLogLog()
+        self.last = (None, None)
+    
+    def hashes(self, line):
+        """line 为结果行，或 Record 的去重键 (version, ip, host, port, remark)"""
+        if self.last[0] != line:
+            if isinstance(line, tuple):
+                # 与 pack_ip_port 的打包方式一致
+                version, value, host, port, _ = line
+                if version:
+                    key = ((value | (1 << 128) if version == 6 else value) << 17) | (port + 1 if port else 0)
+                else:
+                    key = (host, str(port or ''))
+            else:
+                ip, port, _ = parse_result_line(line)
+                key = pack_ip_port(ip, port) if ip else line
+            key = key.to_bytes(19, 'big') if isinstance(key, int) else str(key).encode('utf-8')
+            digest = hashlib.blake2b(key, digest_size=16).digest()
+            self.last = (line, (int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1))
+        return self.last[1]
+    
+    def __contains__(self, line):
+        h1, h2 = self.hashes(line)
+        self.hll.add_hash(h1)
+        return self.bloom.contains(h1, h2)
+    
+    def add(self, line):
+        self.bloom.add(*self.hashes(line))
+    
+    def summary(self):
+        return (f"📈 近似去重: 估计不同记录约 {self.hll.estimate()} 条 (HyperLogLog)，"
+                f"布隆过滤器 {len(self.bloom.layers)} 层 / {self.bloom.memory_bytes / (1024 * 1024):.1f}MB，"
+                f"目标误判率 {self.bloom.error_rate}")
+
+def new_seen_set(approx=None):
+    """创建去重集合：approx 为 {'fp_rate': 误判率, 'memory_mb': 内存预算} 时使用近似去重，否则为精确 set"""
+    if approx:
+        return ApproxSeenSet(approx.get('fp_rate', 0.001), approx.get('memory_mb', 64))
+    return set()
+
+def print_dedup_summary(seen):
+    """近似去重时输出估计的不同记录数，便于判断是否改回精确去重"""
+    if isinstance(seen, ApproxSeenSet):
+        print(seen.summary())
+
+def metric_from_remark(remark):
+    """从备注中取第一个可解析的指标（如 HK|20ms → 20）"""
+    for token in re.split(r'[|,\s#]+', remark or ''):
+        value = parse_metric_value(token)
+        if value is not None and not token.isdigit():
+            return value
+    return None
+
+def dedup_lines_by_endpoint(lines, policy='first', key='ipport'):
+    """结果行按 IP+端口（key='ip' 时仅按IP）去重，min/max 策略比较备注中的指标；工作表分隔行原样保留"""
+    output = []
+    segment = []
+    
+    def flush():
+        parsed = [(line, parse_result_line(line)) for line in segment]
+        kept = dedup_by_key(
+            parsed,
+            lambda item: pack_ip_port(item[1][0], item[1][1] if key == 'ipport' else None) if item[1][0] else item[0],
+            policy,
+            lambda item: metric_from_remark(item[1][2]),
+        )
+        output.extend(line for line, _ in kept)
+        segment.clear()
+    
+    for line in lines:
+        if line.startswith('-----'):
+            flush()
+            output.append(line)
+        else:
+            segment.append(line)
+    flush()
+    
+    before = len([line for line in lines if not line.startswith('-----')])
+    after = len([line for line in output if not line.startswith('-----')])
+    print(f"✅ 按 {'IP+端口' if key == 'ipport' else 'IP'} 去重({policy}): {before} 条 → {after} 条")
+    return output
+
+def dedup_records_by_endpoint(records, policy='first', key='ipport'):
+    """Record 按 IP+端口（key='ip' 时仅按IP）去重，min/max 策略比较备注中的指标"""
+    records = list(records)
+    kept = dedup_by_key(
+        records,
+        lambda record: (record.version, record.ip, record.host, record.port if key == 'ipport' else None),
+        policy,
+        lambda record: metric_from_remark(record.remark),
+    )
+    print(f"✅ 按 {'IP+端口' if key == 'ipport' else 'IP'} 去重({policy}): {len(records)} 条 → {len(kept)} 条")
+    return kept
+
+def ask_dedup_policy(metric_hint=""):
+    """交互选择重复时的保留策略"""
+    choice = input(f"重复时保留: 1. 第一条(默认) 2. 最后一条 3. 指标最小{metric_hint} 4. 指标最大{metric_hint}: ").strip()
+    return {'2': 'last', '3': 'min', '4': 'max'}.get(choice, 'first')
+
+def get_row_values(row, selected_columns):
+    """取出一行中所选列的值，IP地址列自动清理"""
+    column_values = []
+    for col in selected_columns:
+        value = str(row[col]).strip() if pd.notna(row[col]) else ""
+        # 如果是IP地址列，进行清理
+        if 'IP' in col or 'ip' in col.lower():
+            value = clean_ip(value)
+        column_values.append(value)
+    return column_values
+
+def render_template(format_template, column_values):
+    """将列值填入输出格式模板"""
+    result_line = format_template
+    for j in range(len(column_values)):
+        result_line = result_line.replace(f"[{j+1}]", column_values[j])
+    return result_line
+
+def iter_custom_rows(df, selected_columns, format_template, deduplicate=True):
+    """逐行生成 (输出行, 所选列的值)，可按输出行去重"""
+    seen = set() if deduplicate else None
+    for _, row in df.iterrows():
+        try:
+            column_values = get_row_values(row, selected_columns)
+            result_line = render_template(format_template, column_values)
+        except:
+            continue
+        
+        if deduplicate:
+            if result_line in seen:
+                continue
+            seen.add(result_line)
+        yield result_line, column_values
+
+def truncate_format(format_template, max_columns):
+    """根据最大列数截断格式"""
     # 移除超过max_columns的占位符
     for i in range(max_columns + 1, 10):
         format_template = format_template.replace(f'[{i}]', '')
@@ -652,11 +2356,8 @@ def custom_mode():
         sheet_name = list(dfs_dict.keys())[0]
         df = dfs_dict[sheet_name]
         print(f"📊 已选择工作表: {sheet_name}")
-        
-    elif file_ext in ['.csv']:
-        df = process_csv_file(file_path)
     else:
-        df = smart_parse_text(file_path)
+        df = read_input_frame(file_path)
     
     if df is None:
         print("❌ 无法解析文件")
@@ -664,6 +2365,16 @@ def custom_mode():
     
     print(f"✅ 成功读取文件，共 {len(df)} 行")
     
+    # 离线注释：按IP列查找国家/ASN等，追加为新列，可在输出格式和过滤条件中使用
+    annotate_source = input("🏷️  离线IP段数据库路径(添加国家/ASN等注释列，直接回车跳过): ").strip('"').strip()
+    if annotate_source:
+        try:
+            annotations = load_annotation_index(annotate_source)
+            df = annotations.annotate_frame(df, resolve_filter_column(df, 'ip'))
+            print(f"✅ 已添加注释列: {', '.join(annotations.fields)}")
+        except Exception as e:
+            print(f"❌ 添加注释失败: {e}")
+    
     # 显示所有列
     print("\n📊 文件包含以下列:")
     for i, col in enumerate(df.columns, 1):
@@ -675,6 +2386,17 @@ def custom_mode():
         sample_preview = " | ".join(sample_values[:2]) if sample_values else "空"
         print(f"  {i}. {col} → 示例: {sample_preview}")
     
+    # 过滤条件：列名或 [列号] 引用上面的列，在格式化和去重之前生效
+    while True:
+        try:
+            where = ask_where_filter()
+            if where:
+                df = where.filter_frame(df)
+                print(f"🔎 过滤后剩余 {len(df)} 行（排除 {where.rejected} 行）")
+            break
+        except WhereError as e:
+            print(f"❌ {e}，请重新输入")
+    
     # 选择要输出的列
     print("\n🎯 请选择要输出的列（输入数字，用空格分隔，如: 1 2 3 4 5）:")
     selected_indices = input("选择列: ").strip().split()
@@ -751,18 +2473,8 @@ def custom_mode():
     preview_ok = False
     for i in range(min(3, len(df))):
         try:
-            column_values = []
-            for col in selected_columns:
-                value = str(df.iloc[i][col]).strip() if pd.notna(df.iloc[i][col]) else ""
-                # 如果是IP地址列，进行清理
-                if 'IP' in col or 'ip' in col.lower():
-                    value = clean_ip(value)
-                column_values.append(value)
-            
-            result_line = format_template
-            for j in range(len(column_values)):
-                result_line = result_line.replace(f"[{j+1}]", column_values[j])
-            
+            column_values = get_row_values(df.iloc[i], selected_columns)
+            result_line = render_template(format_template, column_values)
             print(f"  {i+1}. {result_line}")
             preview_ok = True
         except Exception as e:
@@ -781,14 +2493,58 @@ def custom_mode():
     # 处理选项
     deduplicate = input("🔄 是否去重? (y/n, 默认y): ").strip().lower() != 'n'
     
+    # 按指定列去重：每个键只保留一行（第一条/最后一条/指标最优）
+    dedup_indices = []
+    if deduplicate:
+        key_choice = input("去重依据(直接回车按整行输出；输入列号按指定列，如 1 2 表示按IP+端口): ").strip().split()
+        dedup_indices = [int(index) - 1 for index in key_choice if index.isdigit() and 1 <= int(index) <= selected_count]
+        if dedup_indices:
+            dedup_policy = ask_dedup_policy()
+            dedup_metric_index = None
+            if dedup_policy in ['min', 'max']:
+                metric_choice = input("指标列(如延迟、速度，默认最后一列): ").strip()
+                dedup_metric_index = int(metric_choice) - 1 if metric_choice.isdigit() and 1 <= int(metric_choice) <= selected_count else selected_count - 1
+            print(f"✅ 按第{'、'.join(str(index + 1) for index in dedup_indices)}列去重，保留策略: {dedup_policy}")
+    
+    # Top-K：只保留指标最优的K行（可按组）
+    top_k = None
+    top_k_input = input("🏆 只保留指标最优的K行? 输入K(直接回车不启用): ").strip()
+    if top_k_input.isdigit() and int(top_k_input) > 0:
+        top_k = int(top_k_input)
+        print("选择指标列(如延迟、下载速度):")
+        for i, col in enumerate(selected_columns, 1):
+            print(f"  {i}. {col}")
+        metric_choice = input("指标列(默认最后一列): ").strip()
+        metric_index = int(metric_choice) - 1 if metric_choice.isdigit() and 1 <= int(metric_choice) <= selected_count else selected_count - 1
+        
+        sample_metric = df[selected_columns[metric_index]].dropna().head(1).tolist()
+        default_largest = bool(sample_metric) and metric_prefers_larger(sample_metric[0])
+        direction = input(f"1. 越小越好(延迟)  2. 越大越好(速度)  (默认{2 if default_largest else 1}): ").strip()
+        largest = direction == "2" or (direction != "1" and default_largest)
+        
+        group_choice = input("按哪一列分组取K行(如地区/colo，直接回车不分组): ").strip()
+        group_index = int(group_choice) - 1 if group_choice.isdigit() and 1 <= int(group_choice) <= selected_count else None
+        print(f"✅ 按第{metric_index + 1}列{'最大' if largest else '最小'}取前 {top_k} 行" + (f"，按第{group_index + 1}列分组" if group_index is not None else ""))
+    
     print("\n📊 排序选项:")
-    print("0. 不排序")
+    print("0. 不排序" + ("（保持Top-K从优到差的顺序）" if top_k else ""))
     for i, col in enumerate(selected_columns, 1):
         print(f"{i}. 按第{i}列 ({col}) 排序")
     
-    sort_choice = input("请选择排序方式(默认0): ").strip() or "0"
+    print("多列排序: 列:方向:类型，用逗号分隔，如 4:asc:float,1:asc:ip（类型 ip/int/float/text，省略时自动推断）")
+    
+    sort_keys = []
+    while True:
+        sort_choice = input("请选择排序方式(默认0): ").strip() or "0"
+        if sort_choice == "0":
+            break
+        try:
+            sort_keys = parse_sort_spec(sort_choice, selected_count)
+            break
+        except ValueError as e:
+            print(f"❌ {e}，请重新输入")
     
-    output_file = input("\n💾 输出文件名(默认custom_results): ").strip()
+    output_file = input("\n💾 输出文件名(默认custom_results，.parquet/.feather/.arrow 输出列式文件): ").strip()
     if not output_file:
         output_file = "custom_results"
     
@@ -796,58 +2552,87 @@ def custom_mode():
     
     # 处理所有数据
     print("\n⏳ 正在处理数据...")
-    results = []
-    seen = set() if deduplicate else None
-    
-    processed_count = 0
-    for _, row in df.iterrows():
+    results = run_custom_pipeline(
+        df, selected_columns, format_template, deduplicate,
+        dedup_indices, dedup_policy if dedup_indices else 'first', dedup_metric_index if dedup_indices else None,
+        top_k, metric_index if top_k else None, largest if top_k else False, group_index if top_k else None,
+        sort_keys,
+    )
+    save_custom_results(results, selected_columns, output_path)
+
+def read_input_frame(file_path, sheet=None):
+    """按扩展名将输入文件读取为DataFrame；Excel 未指定工作表时读取第一个工作表"""
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext in ['.xlsx', '.xls']:
+        sheet = sheet or pd.ExcelFile(file_path).sheet_names[0]
+        dfs_dict = process_excel_file(file_path, [sheet])
+        return dfs_dict.get(sheet) if dfs_dict else None
+    elif file_ext in ['.csv']:
+        return process_csv_file(file_path)
+    elif get_columnar_format(file_path):
         try:
-            column_values = []
-            for col in selected_columns:
-                value = str(row[col]).strip() if pd.notna(row[col]) else ""
-                if 'IP' in col or 'ip' in col.lower():
-                    value = clean_ip(value)
-                column_values.append(value)
-            
-            result_line = format_template
-            for j in range(len(column_values)):
-                result_line = result_line.replace(f"[{j+1}]", column_values[j])
-            
-            if deduplicate:
-                if result_line not in seen:
-                    seen.add(result_line)
-                    sort_value = column_values[int(sort_choice)-1] if sort_choice.isdigit() and 1 <= int(sort_choice) <= len(selected_columns) else result_line
-                    results.append((result_line, sort_value))
-                    processed_count += 1
-            else:
-                sort_value = column_values[int(sort_choice)-1] if sort_choice.isdigit() and 1 <= int(sort_choice) <= len(selected_columns) else result_line
-                results.append((result_line, sort_value))
-                processed_count += 1
-                    
-        except:
-            continue
+            return read_columnar_file(file_path)
+        except Exception as e:
+            print(f"❌ 列式文件读取失败: {e}")
+            return None
+    else:
+        return smart_parse_text(file_path)
+
+def run_custom_pipeline(df, selected_columns, format_template, deduplicate=True,
+                        dedup_indices=None, dedup_policy='first', dedup_metric_index=None,
+                        top_k=None, metric_index=None, largest=False, group_index=None,
+                        sort_keys=None, drop=None):
+    """自定义模式处理流程：校验 → 格式化 → 去重 → Top-K → 排序，返回 [(输出行, 所选列的值)]
     
-    print(f"✅ 已处理 {processed_count} 行数据")
+    所选列包含检测到的IP列时，与快速模式一样校验IP和端口（drop 为额外丢弃的地址类别）
+    """
+    columns = detect_frame_columns(df)
+    if columns[0] in selected_columns:
+        validator = EndpointValidator(drop)
+        df = validate_frame(df, validator, columns)
+        print_validation_summary(validator)
+    
+    rows = iter_custom_rows(df, selected_columns, format_template, deduplicate and not dedup_indices)
+    if dedup_indices:
+        rows = dedup_by_key(
+            rows,
+            lambda item: tuple(compact_key_part(item[1][index]) for index in dedup_indices),
+            dedup_policy,
+            (lambda item: parse_metric_value(item[1][dedup_metric_index])) if dedup_metric_index is not None else None,
+        )
+        print(f"✅ 按键去重后剩余 {len(rows)} 行")
+    
+    if top_k:
+        results, skipped = select_top_k(
+            rows, top_k,
+            lambda item: parse_metric_value(item[1][metric_index]),
+            largest,
+            (lambda item: item[1][group_index]) if group_index is not None else None,
+        )
+        print(f"✅ Top-K 筛选完成，保留 {len(results)} 行" + (f"，{skipped} 行指标无法解析已跳过" if skipped else ""))
+    else:
+        results = list(rows)
+        print(f"✅ 已处理 {len(results)} 行数据")
     
     # 排序
-    if sort_choice != "0":
-        try:
-            results.sort(key=lambda x: x[1])
-            print(f"✅ 已按第{sort_choice}列排序")
-        except:
-            results.sort(key=lambda x: x[0])
-            print("⚠️  按指定列排序失败，已按输出内容排序")
+    if sort_keys:
+        results = sort_by_spec(results, sort_keys, lambda item: item[1])
+        print(f"✅ 已排序: {describe_sort_spec(sort_keys)}")
+    elif top_k:
+        print("✅ 已按指标从优到差排序")
     else:
-        results.sort(key=lambda x: x[0])
+        results.sort(key=lambda x: result_sort_key(x[0]))
         print("✅ 已按输出内容排序")
-    
+    return results
+
+def save_custom_results(results, selected_columns, output_path):
+    """保存自定义模式结果并预览前10条"""
     sorted_results = [item[0] for item in results]
     
-    # 保存结果
+    # 保存结果（列式输出时附带所选的源列）
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for line in sorted_results:
-                f.write(line + '\n')
+        source_columns = {col: [item[1][j] for item in results] for j, col in enumerate(selected_columns)}
+        write_results_file(sorted_results, output_path, source_columns)
         
         print(f"\n🎉 处理完成！共生成 {len(sorted_results)} 条记录")
         print(f"💾 输出文件: {output_path}")
@@ -859,6 +2644,310 @@ def custom_mode():
     except Exception as e:
         print(f"❌ 保存文件失败: {e}")
 
+# 任务文件字段（列号均从1开始，dedup_key/dedup_metric/top_metric/group 指所选列中的序号）
+JOB_FIELDS = {
+    'input', 'sheet', 'annotate', 'where', 'columns', 'template', 'dedup', 'dedup_key', 'keep', 'dedup_metric',
+    'top_k', 'top_metric', 'largest', 'group', 'sort', 'drop', 'output',
+}
+
+def load_job_file(job_path):
+    """读取 JSON/TOML 任务文件，返回任务列表（defaults 中的字段作为每个任务的默认值）"""
+    if os.path.splitext(job_path)[1].lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise RuntimeError("读取TOML任务文件需要 Python 3.11+ 或安装 tomli: pip install tomli")
+        with open(job_path, 'rb') as f:
+            spec = tomllib.load(f)
+    else:
+        with open(job_path, 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+    
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    defaults = spec.get('defaults', {})
+    jobs = [dict(defaults, **job) for job in spec.get('jobs', [])]
+    for i, job in enumerate(jobs, 1):
+        unknown = set(job) - JOB_FIELDS
+        if unknown:
+            raise ValueError(f"任务{i} 包含未知字段: {', '.join(sorted(unknown))}")
+        if not job.get('input') or not job.get('columns'):
+            raise ValueError(f"任务{i} 缺少 input 或 columns")
+    return jobs
+
+def job_column_index(value, field, column_count, default=None):
+    """将任务中的列序号（从1开始）转换为下标"""
+    if value is None:
+        return default
+    if not isinstance(value, int) or not 1 <= value <= column_count:
+        raise ValueError(f"{field} 应为 1 到 {column_count} 之间的列序号")
+    return value - 1
+
+def run_job(job, df):
+    """按任务配置执行一次自定义模式处理"""
+    if job.get('annotate'):
+        annotations = load_annotation_index(job['annotate'])
+        df = annotations.annotate_frame(df, resolve_filter_column(df, 'ip'))
+    if job.get('where'):
+        where = compile_where(job['where'])
+        df = where.filter_frame(df)
+        print(f"🔎 过滤后剩余 {len(df)} 行（排除 {where.rejected} 行）")
+    
+    selected_columns = [resolve_filter_column(df, str(col)) for col in job['columns']]
+    selected_count = len(selected_columns)
+    format_template = truncate_format(job.get('template', '[1]'), selected_count)
+    
+    dedup_indices = [job_column_index(index, 'dedup_key', selected_count) for index in job.get('dedup_key', [])]
+    dedup_policy = job.get('keep', 'first')
+    if dedup_policy not in DEDUP_POLICIES:
+        raise ValueError(f"keep 应为 {'/'.join(DEDUP_POLICIES)} 之一")
+    dedup_metric_index = None
+    if dedup_indices and dedup_policy in ['min', 'max']:
+        dedup_metric_index = job_column_index(job.get('dedup_metric'), 'dedup_metric', selected_count, selected_count - 1)
+    
+    top_k = job.get('top_k')
+    metric_index = group_index = None
+    largest = False
+    if top_k:
+        metric_index = job_column_index(job.get('top_metric'), 'top_metric', selected_count, selected_count - 1)
+        group_index = job_column_index(job.get('group'), 'group', selected_count)
+        largest = job.get('largest')
+        if largest is None:
+            sample_metric = df[selected_columns[metric_index]].dropna().head(1).tolist()
+            largest = bool(sample_metric) and metric_prefers_larger(sample_metric[0])
+    
+    sort_keys = parse_sort_spec(str(job['sort']), selected_count) if job.get('sort') else []
+    drop = job.get('drop', [])
+    drop = [drop] if isinstance(drop, str) else drop
+    unknown = set(drop) - set(DROP_CATEGORIES)
+    if unknown:
+        raise ValueError(f"drop 应为 {'/'.join(DROP_CATEGORIES)} 中的类别")
+    
+    results = run_custom_pipeline(
+        df, selected_columns, format_template, job.get('dedup', True),
+        dedup_indices, dedup_policy, dedup_metric_index,
+        top_k, metric_index, largest, group_index,
+        sort_keys, drop,
+    )
+    save_custom_results(results, selected_columns, get_safe_output_path(job.get('output', 'custom_results')))
+
+def run_job_file(job_path, changed=None):
+    """无交互执行任务文件：每个不同的输入（文件+工作表）只解析一次，供所有引用它的任务共用
+    
+    changed: 只运行输入文件在此集合（绝对路径）中的任务，监视模式使用
+    """
+    try:
+        jobs = load_job_file(job_path)
+    except Exception as e:
+        print(f"❌ 任务文件读取失败: {e}")
+        return
+    
+    if changed is not None:
+        jobs = [job for job in jobs if os.path.abspath(job['input']) in changed]
+    print(f"📋 任务文件包含 {len(jobs)} 个{'受影响的' if changed is not None else ''}任务")
+    frame_cache = {}
+    failed = 0
+    for i, job in enumerate(jobs, 1):
+        print(f"\n=== 任务 {i}/{len(jobs)}: {job['input']} → {job.get('output', 'custom_results')} ===")
+        cache_key = (os.path.abspath(job['input']), job.get('sheet'))
+        if cache_key not in frame_cache:
+            if not os.path.exists(job['input']):
+                print(f"❌ 文件不存在: {job['input']}")
+                frame_cache[cache_key] = None
+            else:
+                frame_cache[cache_key] = read_input_frame(job['input'], job.get('sheet'))
+        else:
+            print("♻️  复用已解析的输入")
+        
+        df = frame_cache[cache_key]
+        if df is None:
+            failed += 1
+            continue
+        try:
+            run_job(job, df)
+        except Exception as e:
+            print(f"❌ 任务 {i} 执行失败: {e}")
+            failed += 1
+    
+    print(f"\n✅ 任务完成: {len(jobs) - failed} 成功，{failed} 失败")
+
+# ---- 库接口 ----
+# 作为库嵌入其他程序时使用，例如:
+#   import ip_tool
+#   for record in ip_tool.iter_records("nodes.csv", mode="ipspace", port=443, drop=["bogon"]):
+#       print(record.address, record.port)
+RECORD_ANNOTATE_BATCH = 10000
+
+class Record(namedtuple('Record', ['ip', 'port', 'remark', 'row', 'version', 'host'], defaults=(None,))):
+    """紧凑的端点记录：ip 为整数（IPv4 32位 / IPv6 128位），port 为整数（0 表示无端口），
+    remark 为备注（无备注为None），row 为来源行号（无法确定时为 -1），version 为 4 或 6；
+    链接中的域名等非IP主机 version 为0、ip 为0，host 为主机名原文（带区域ID的IPv6 也在 host 中保留原文）"""
+    __slots__ = ()
+    
+    @classmethod
+    def from_endpoint(cls, host, port=None, remark=None, row=-1):
+        """由提取出的 (主机, 端口文本, 备注) 生成记录"""
+        port = int(port) if port and str(port).isdigit() else 0
+        row = row if type(row) is int else int(row) if isinstance(row, np.integer) else -1
+        # 校验后的IPv4 已是标准写法，由 inet_pton 直接转为整数
+        if ':' not in host:
+            try:
+                return cls(int.from_bytes(socket.inet_pton(socket.AF_INET, host), 'big'), port, remark or None, row, 4)
+            except (OSError, ValueError, TypeError):
+                pass
+        value = ip_to_int(host)
+        if value is None:
+            return cls(0, port, remark or None, row, 0, str(host))
+        version = 6 if ':' in host else 4
+        # IPv6 的区域ID和 IPv4映射的点分写法无法由整数还原，保留原文
+        return cls(value, port, remark or None, row, version, host if version == 6 and ('%' in host or '.' in host) else None)
+    
+    @classmethod
+    def from_line(cls, line, row=-1):
+        """由一行 IP:端口#备注 文本生成记录；无法解析的行整体作为主机名"""
+        ip, port, remark = parse_result_line(line)
+        if ip is None:
+            return cls(0, 0, None, row, 0, line)
+        return cls.from_endpoint(ip, port, remark, row)
+    
+    @property
+    def address(self):
+        """IP地址文本（IPv6 为标准压缩形式），非IP主机为主机名"""
+        if self.host is not None:
+            return self.host
+        if self.version == 4:
+            return socket.inet_ntoa(self.ip.to_bytes(4, 'big'))
+        return str(ipaddress.IPv6Address(self.ip))
+    
+    @property
+    def sort_key(self):
+        """排序键：IPv4在前、IPv6在后按数值，非IP主机按文本排在最后；同一地址按端口，无端口在前"""
+        if self.version == 0:
+            return (1, 0, self.host, self.port or -1)
+        return (0, self.ip | (1 << 128) if self.version == 6 else self.ip, '', self.port or -1)
+    
+    def format(self, mode='ipportremark', default_port=""):
+        """按输出模式（ipportremark/ipspace/iponly/cidr、对应的提取模式名或规范记录模式）格式化为一行
+        
+        没有端口时使用 default_port；该模式要求端口而仍没有端口时返回None
+        """
+        extract_mode = CLI_MODES.get(mode, mode)
+        port = self.port or default_port
+        if not port and extract_mode not in PORT_OPTIONAL_MODES:
+            return None
+        # 仅IP或没有端口时只写地址；空格分隔模式写 "地址 端口"，其余为 地址:端口（IPv6 加方括号）
+        address = self.address
+        if extract_mode == "ip_only" or not port:
+            result = address
+        elif extract_mode in ["ip_space_port", "cidr"]:
+            result = f"{address} {port}"
+        else:
+            result = f"[{address}]:{port}" if ':' in address else f"{address}:{port}"
+        # 规范记录行没有端口时也保留备注（IP#备注），读回时备注不会丢失
+        if self.remark and extract_mode in ["ip_port_remark", RECORD_MODE]:
+            result += f"#{self.remark}"
+        return result
+
+def iter_endpoint_records(endpoints, mode=RECORD_MODE, seen=None, annotations=None, tag=None):
+    """将 (行号, 主机, 端口, 备注) 端点转为 Record（生成器）
+    
+    seen: 去重集合（精确 set 或近似去重集合），按 (version, ip, host, port, remark) 判重，
+          输出模式不含备注时不比较 remark；None 时不去重
+    annotations: 注释索引，按批查找后按 tag 模板追加到 remark
+    """
+    extract_mode = CLI_MODES.get(mode, mode)
+    keep_remark = extract_mode in ["ip_port_remark", RECORD_MODE]
+    require_port = port_required(extract_mode)
+    
+    def build_records():
+        for row, host, port, remark in endpoints:
+            record = Record.from_endpoint(host, None if extract_mode == "ip_only" else port, remark, row)
+            if require_port and not record.port:
+                continue
+            if seen is not None:
+                key = (record.version, record.ip, record.host, record.port, record.remark if keep_remark else None)
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield record
+    
+    records = build_records()
+    if annotations is None:
+        yield from records
+        return
+    
+    # 注释按批查找，每批一次二分查找
+    tag_template = tag or " ".join(f"[{field}]" for field in annotations.fields)
+    for batch in iter(lambda: list(itertools.islice(records, RECORD_ANNOTATE_BATCH)), []):
+        labels = annotations.lookup_batch([record.address if record.version else '' for record in batch])
+        for i, record in enumerate(batch):
+            annotation = {field: labels[field][i] for field in annotations.fields}
+            tag_text = render_tag(tag_template, annotation) if any(annotation.values()) else ""
+            remark = " ".join(part for part in [record.remark, tag_text] if part)
+            yield record._replace(remark=remark or None)
+
+def iter_records(source, mode='ipportremark', port=None, where=None, drop=None, annotate=None, tag=None,
+                 expand=None, sheets=None, dedup=True, validator=None, seen=None):
+    """逐条读取输入中的端点，边读边生成 Record（生成器）
+    
+    source: 文件路径（文本/链接/CSV/Excel/列式文件），或已打开的文本流
+    mode: 输出模式，决定是否要求端口；iponly 时 port 恒为0
+    port: 默认端口，补给没有端口的记录
+    where: 过滤表达式文本或 compile_where 的结果
+    drop: 丢弃的地址类别，如 ['private', 'bogon']
+    annotate: 离线IP段数据库路径或 AnnotationIndex，注释按 tag 模板追加到 remark
+    dedup: 按输出模式格式化后的行去重（ipportremark 时备注不同的记录都保留），保留第一条
+    validator: 共享的 EndpointValidator（统计被排除的记录），给出时忽略 drop
+    seen: 共享的去重集合（如近似去重集合），给出时忽略 dedup
+    链接中的域名等非IP主机也生成记录（version 为0）
+    """
+    extract_mode = CLI_MODES.get(mode, mode)
+    annotations = load_annotation_index(annotate) if isinstance(annotate, (str, os.PathLike)) else annotate
+    if isinstance(where, str):
+        where = compile_where(where)
+    if where is not None and annotations is not None:
+        where.annotations = annotations
+    validator = EndpointValidator(drop or []) if validator is None else validator
+    if seen is None and dedup:
+        seen = set()
+    endpoints = iter_source_endpoints(source, extract_mode, "" if port is None else str(port), where,
+                                      validator, expand, sheets)
+    yield from iter_endpoint_records(endpoints, extract_mode, seen, annotations, tag)
+
+def records_to_arrays(records):
+    """将记录转为 numpy 列数组 {ip, port, remark, row, version}；全部为IPv4时 ip 为 uint32，含IPv6时为 object（Python整数）
+    
+    非IP主机的记录 ip 为0、version 为0
+    """
+    records = list(records)
+    versions = np.fromiter((record.version for record in records), dtype=np.uint8, count=len(records))
+    return {
+        'ip': np.array([record.ip for record in records], dtype=object if (versions == 6).any() else np.uint32),
+        'port': np.fromiter((record.port for record in records), dtype=np.uint16, count=len(records)),
+        'remark': np.array([record.remark for record in records], dtype=object),
+        'row': np.fromiter((record.row for record in records), dtype=np.int64, count=len(records)),
+        'version': versions,
+    }
+
+def read_record_arrays(source, **options):
+    """批量读取为 numpy 列数组，参数同 iter_records"""
+    return records_to_arrays(iter_records(source, **options))
+
+def read_records(source, **options):
+    """批量读取为DataFrame，参数同 iter_records；列类型与列式输出一致（ip/port/remark/ip_version/ip_int），另有来源行号 row"""
+    records = list(iter_records(source, **options))
+    return pd.DataFrame({
+        'ip': pd.array([record.address for record in records], dtype='string'),
+        'port': pd.array([record.port or None for record in records], dtype='UInt16'),
+        'remark': pd.array([record.remark for record in records], dtype='string'),
+        'ip_version': pd.array([record.version or None for record in records], dtype='UInt8'),
+        'ip_int': pd.array([record.ip if record.version == 4 else None for record in records], dtype='UInt32'),
+        'row': pd.array([record.row for record in records], dtype='Int64'),
+    })
+
 def show_usage():
     """显示使用说明"""
     program_name = os.path.basename(sys.argv[0])
@@ -873,124 +2962,1173 @@ def show_usage():
 命令行参数:
   -u, --usage         显示此使用说明
   -f, --file string   输入文件路径
-  -m, --mode string   输出模式: ipportremark(IP:端口#备注), ipspace(IP 空格 端口), iponly(仅IP)
-                      默认: ipspace
-  -o, --out string    输出文件名 (默认: "results.txt")
-  -p, --port int      默认端口号 (默认: 443)
+  -m, --mode string   输出模式: ipportremark(IP:端口#备注), ipspace(IP 空格 端口), iponly(仅IP),
+                      cidr(聚合为CIDR块，有端口时按端口分别聚合)，
+                      link(按链接模板生成节点链接), sub(节点链接整体 base64 编码，即订阅内容)
+                      默认: ipspace；可指定多个模式，只读取和提取一次
+  -o, --out string    输出文件名 (默认: "results.txt")，多个模式时按顺序一一对应；
+                      只给一个文件名时自动命名为 文件名_模式.txt
+                      扩展名为 .parquet/.feather/.arrow 时输出带类型的列式文件；- 表示写到标准输出
+  -p, --port int      默认端口号 (默认: 443，cidr模式默认不添加)
+  -e, --expand        展开文本中的CIDR/IP段 (如 104.16.0.0/20、1.1.1.1-1.1.1.255)
+  --limit int         展开的IP总数上限
+  --sample int        每个地址段随机抽样的IP数量
+  -w, --where string  过滤条件，在格式化和去重之前生效，如:
+                      "port in (443,2053,8443) and 延迟 < 150 and not bogon"
+                      运算符: = != < <= > >= ~(正则) in (...) not in (...)，关键字: private bogon ipv4 ipv6
+                      文本输入可用字段: ip port remark；表格输入可用列名或 [列号]
+  --dedup-key string  去重依据: line(整行输出，默认), ipport(IP+端口), ip(仅IP)
+  --keep string       按键去重时保留: first(默认), last, min, max (min/max 比较备注中的延迟/速度)
+  --drop string ...   丢弃指定类别的地址: private(私有) reserved(回环/链路本地/组播等保留) bogon(所有不可公网路由)
+                      IP八位组和端口始终按整数校验（拒绝 999.1.1.1、端口 99999），前导零统一去掉
+  --annotate string   离线IP段数据库(CSV: network 或 start/end 列 + 注释列)，注释追加到备注，
+                      注释字段可用于 -w 过滤；首次使用时编译为 数据库.idx，之后直接内存映射加载
+  --tag string        注释标签模板，如 "[country]-[asn]" (默认: 所有注释字段用空格连接)
+  --approx-dedup      近似去重：布隆过滤器按 IP+端口 判重，内存固定，适合无界输入或超大文件
+  --fp-rate float     近似去重的目标误判率 (默认: 0.001)
+  --dedup-memory int  近似去重的内存预算MB (默认: 64)
+  -f -                从标准输入读取文本，边读边写（不排序）
+  --link-template string
+                      link/sub 模式的链接模板(链接或包含链接的文件)，保留UUID和参数，替换地址、端口和备注；
+                      输入为链接文件时默认使用其中第一条链接
+  --memory-budget int 内存预算MB (默认: 可用内存的一半)；按输入大小、格式、可用内存和CPU数自动选择
+                      整体读入 / 分块流式 / 多进程并行 / 外部排序，执行计划在运行摘要中输出
+  -j, --job string    执行 JSON/TOML 任务文件：无交互地批量运行自定义模式，同一输入只解析一次
+
+集合运算:
+  {program_name} setop union|intersect|diff 文件1 文件2 ... [-o 输出] [-k ipport|ip|line]
+                      对结果文件流式求并集/交集/差集(第一个文件减去其余文件)，未排序的文件自动外部排序
+
+监视模式:
+  {program_name} watch 文件或目录 ... [-m 模式 ...] [-o 输出 ...] [-j 任务文件] [--debounce 秒] [--interval 秒] [--poll]
+                      输入变化时自动更新输出：文本文件只处理新追加的行，表格文件整体重新处理；
+                      Linux 使用 inotify，其他系统按修改时间/大小轮询；输出先写临时文件再替换
+                      支持 -p -w --drop --annotate --tag --link-template --dedup-key --keep；指定 -j 时重新运行输入有变化的任务
 
 示例:
   {program_name} -f data.txt -m ipportremark -o output.txt
   {program_name} -f data.xlsx -m ipspace -p 8080
+  {program_name} -f data.txt -m ipspace iponly ipportremark -o space.txt ip.txt remark.txt
+  {program_name} -f ips.txt -m cidr -o cidr.txt
+  {program_name} -f ranges.txt -e --sample 5 -m ipspace
+  {program_name} -f result.csv -w "port in (443,8443) and 地区 in (HK,JP,SG)"
+  {program_name} -f merged.txt -m ipportremark --dedup-key ipport --keep min
+  cat *.txt | {program_name} -f - --approx-dedup -o stream.txt
+  {program_name} -f huge.txt -m ipspace iponly -o space.txt ip.txt --memory-budget 512
+  {program_name} -f ip_port_remark_results.txt -m sub -o - --link-template "vless://uuid@example.com:443?type=ws&security=tls#x"
+  {program_name} setop diff new_scan.txt blocked.txt -o fresh.txt
+  {program_name} watch speedtest/ -m ipportremark ipspace -o all.txt space.txt
+  {program_name} -j nightly.json
+  {program_name} -f ips.txt -m ipportremark --annotate ranges.csv -w "country in (HK,JP)"
 
 支持的文件格式:
   • 文本文件: .txt
   • Excel文件: .xlsx, .xls  
   • CSV文件: .csv
+  • 列式文件: .parquet, .feather, .arrow (需要 pyarrow)
 
 输出格式示例:
   • IP:端口#备注: 192.168.1.1:443#CN
   • IP 空格 端口: 192.168.1.1 443
   • 仅IP: 192.168.1.1
+  • CIDR聚合: 104.16.0.0/20 443
     """)
 
+def iter_until_interrupt(lines):
+    """Ctrl+C 时结束迭代而不是抛出，已读到的内容照常处理"""
+    try:
+        yield from lines
+    except KeyboardInterrupt:
+        print("\n⏹️  已中断输入")
+
+def stream_lines_to_file(lines, output_path, extract_mode, default_port="", where=None, seen=None, validator=None, expand=None):
+    """边读边写：逐行提取、去重后立即写入临时文件（不排序），结束时替换输出文件，内存只占用去重集合"""
+    try:
+        records = iter_records(iter_until_interrupt(lines), extract_mode, default_port, where, expand=expand,
+                               validator=validator, seen=seen)
+        count = write_results_file((record.format(extract_mode) for record in records), output_path)
+    except Exception as e:
+        print(f"❌ 保存文件失败: {e}")
+        return
+    
+    print_validation_summary(validator)
+    if where:
+        print(f"🔎 过滤条件排除了 {where.rejected} 条记录")
+    print_dedup_summary(seen)
+    print(f"✅ 处理完成！共生成 {count} 条去重记录")
+    print(f"💾 输出文件: {output_path}")
+
+SETOP_OPERATIONS = ['union', 'intersect', 'diff']
+SETOP_RUN_SIZE = 200000
+
+def setop_key(line, key='ipport'):
+    """集合运算的比较键：IP与提取器一致地规范化，按 IP数值、端口 排序和判等（key='line' 时再比较备注）"""
+    ip, port, remark = parse_result_line(line)
+    if ip is None:
+        return (1, 0, line, -1)
+    sort_key = ip_sort_key(normalize_ip(ip) or ip)
+    if key == 'ip':
+        return sort_key
+    sort_key += (int(port) if port else -1,)
+    if key == 'line':
+        sort_key += (remark or '',)
+    return sort_key
+
+def iter_result_lines(file_path):
+    """逐行读取结果文件，跳过空行和工作表分隔行"""
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('-----'):
+                yield line
+
+def is_sorted_results(file_path, key_func):
+    """流式检查结果文件是否已按比较键有序"""
+    previous = None
+    for line in iter_result_lines(file_path):
+        current = key_func(line)
+        if previous is not None and current < previous:
+            return False
+        previous = current
+    return True
+
+def iter_sorted_results(file_path, key_func, temp_dir):
+    """外部排序：每 SETOP_RUN_SIZE 行排序后写入临时文件，再多路归并读出"""
+    run_paths = []
+    lines = iter_result_lines(file_path)
+    while True:
+        run = list(itertools.islice(lines, SETOP_RUN_SIZE))
+        if not run:
+            break
+        run.sort(key=key_func)
+        run_path = os.path.join(temp_dir, f"run_{len(os.listdir(temp_dir))}.txt")
+        with open(run_path, 'w', encoding='utf-8') as f:
+            for line in run:
+                f.write(line + '\n')
+        run_paths.append(run_path)
+    return heapq.merge(*[iter_result_lines(path) for path in run_paths], key=key_func)
+
+def iter_setop(sources, operation, key_func):
+    """k路归并后按比较键分组：union 输出所有键，intersect 输出所有文件都有的键，diff 输出仅第一个文件有的键；每个键输出最先出现的行"""
+    def tag(lines, index):
+        for line in lines:
+            yield key_func(line), index, line
+    
+    keyed = [tag(lines, index) for index, lines in enumerate(sources)]
+    merged = heapq.merge(*keyed, key=lambda item: item[0])
+    for _, group in itertools.groupby(merged, key=lambda item: item[0]):
+        group = list(group)
+        indexes = {index for _, index, _ in group}
+        if operation == 'union' or \
+                (operation == 'intersect' and len(indexes) == len(sources)) or \
+                (operation == 'diff' and indexes == {0}):
+            yield group[0][2]
+
+def setop_mode(argv):
+    """setop 子命令：对多个结果文件做流式并集/交集/差集"""
+    parser = argparse.ArgumentParser(prog='setop', description='结果文件集合运算', add_help=False)
+    parser.add_argument('operation', choices=SETOP_OPERATIONS, help='union(并集) intersect(交集) diff(第一个文件减去其余文件)')
+    parser.add_argument('files', nargs='+', help='输入的结果文件')
+    parser.add_argument('-o', '--out', type=str, default='setop.txt', help='输出文件名')
+    parser.add_argument('-k', '--key', type=str, choices=['ipport', 'ip', 'line'], default='ipport', help='比较依据')
+    args = parser.parse_args(argv)
+    
+    if args.operation != 'union' and len(args.files) < 2:
+        print("❌ 交集和差集至少需要两个文件")
+        return
+    for file_path in args.files:
+        if not os.path.exists(file_path):
+            print(f"❌ 文件不存在: {file_path}")
+            return
+    
+    key_func = lambda line: setop_key(line, args.key)
+    output_path = get_safe_output_path(args.out)
+    print(f"🔧 集合运算: {args.operation}（按 {args.key} 比较）")
+    
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sources = []
+            for file_path in args.files:
+                if is_sorted_results(file_path, key_func):
+                    sources.append(iter_result_lines(file_path))
+                else:
+                    print(f"🔃 {os.path.basename(file_path)} 未排序，使用外部排序")
+                    sources.append(iter_sorted_results(file_path, key_func, temp_dir))
+            
+            count = write_results_file(iter_setop(sources, args.operation, key_func), output_path)
+    except Exception as e:
+        print(f"❌ 集合运算失败: {e}")
+        return
+    
+    print(f"✅ 处理完成！共生成 {count} 条记录")
+    print(f"💾 输出文件: {output_path}")
+
+# ---- 执行计划 ----
+# 按输入大小、格式、可用内存和CPU数选择执行方式：
+#   memory   整体读入内存处理（小文件最快）
+#   chunked  分块读取，每块处理完只保留结果
+#   parallel 分块后由多个进程并行提取
+#   external 结果分段排序写入临时文件，归并时边去重边写出，内存不随结果数增长
+EXECUTION_ENGINES = {'memory': '内存', 'chunked': '分块流式', 'parallel': '并行', 'external': '外部排序'}
+INPUT_FORMAT_NAMES = {'text': '文本', 'special': '链接文件', 'csv': 'CSV', 'excel': 'Excel', 'columnar': '列式文件', 'stdin': '标准输入'}
+# 处理时的内存占用约为输入大小的倍数（Python 字符串、去重集合和 pandas 对象列的开销）
+MEMORY_FACTORS = {'text': 4, 'special': 4, 'csv': 8, 'excel': 20, 'columnar': 6, 'stdin': 4}
+RECORD_BYTES = 150              # 每条结果行在内存中的大致占用
+DEFAULT_MEMORY_BUDGET = 1 << 30  # 无法获取可用内存时的默认预算
+PARALLEL_MIN_SIZE = 64 << 20    # 小于此大小时进程启动和传输的开销大于并行收益
+PARALLEL_MAX_WORKERS = 8
+PLAN_MIN_CHUNK_ROWS = 5000
+PLAN_MAX_CHUNK_ROWS = 1000000
+EXTERNAL_MAX_RUNS = 128         # 临时文件超过此数量时先合并，避免同时打开过多文件
+
+def format_bytes(size):
+    """字节数转为易读的大小文本"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+def available_memory():
+    """可用物理内存（字节），无法获取时返回None"""
+    if sys.platform == 'win32':
+        try:
+            import ctypes
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [('length', ctypes.c_ulong), ('load', ctypes.c_ulong)] + \
+                           [(name, ctypes.c_ulonglong) for name in ['total_phys', 'avail_phys', 'total_page', 'avail_page',
+                                                                    'total_virtual', 'avail_virtual', 'avail_extended']]
+            status = MemoryStatus()
+            status.length = ctypes.sizeof(MemoryStatus)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.avail_phys
+        except (OSError, AttributeError):
+            pass
+        return None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def current_rss():
+    """当前进程的常驻内存（字节），无法获取时返回None（非 Linux 系统返回峰值）"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+def sniff_input_format(source):
+    """判断输入格式：stdin / special / text / excel / columnar / csv（其他扩展名按CSV处理）"""
+    if not isinstance(source, (str, os.PathLike)):
+        return 'stdin'
+    file_ext = os.path.splitext(source)[1].lower()
+    if is_special_format_file(source):
+        return 'special'
+    if file_ext in ['.xlsx', '.xls']:
+        return 'excel'
+    if get_columnar_format(source):
+        return 'columnar'
+    return 'text' if file_ext == '.txt' else 'csv'
+
+def sniff_csv_encoding(file_path):
+    """按文件开头判断CSV编码，尝试顺序与 read_csv_frame 一致"""
+    with open(file_path, 'rb') as f:
+        head = f.read(1 << 20)
+    for encoding in ['utf-8', 'gbk', 'utf-8-sig']:
+        try:
+            head.decode(encoding)
+            return encoding
+        except UnicodeDecodeError as e:
+            # 截断在多字节字符中间不算解码失败
+            if e.start >= len(head) - 3:
+                return encoding
+    return 'latin-1'
+
+def sample_line_length(file_path):
+    """按文件开头估计平均行长（字节）"""
+    with open(file_path, 'rb') as f:
+        head = f.read(1 << 16)
+    return max(1, len(head) // max(1, head.count(b'\n')))
+
+def estimate_expanded_rows(file_path, expand, head_size=1 << 20):
+    """按文件开头的地址段大小估计展开后的行数：开头各行展开数之和按文件大小外推，再受展开上限约束"""
+    limit, sample = expand.get('limit'), expand.get('sample')
+    plain = ranged = 0
+    with open(file_path, 'rb') as f:
+        head = f.read(head_size)
+    if len(head) == head_size:
+        head = head[:head.rfind(b'\n') + 1] or head
+    for line in head.decode('utf-8', errors='ignore').splitlines():
+        match = CIDR_SPEC_RE.search(line)
+        ip_range = parse_ip_range_spec(match.group(1)) if match else None
+        if not ip_range:
+            plain += 1
+            continue
+        size = ip_range[1] - ip_range[0] + 1
+        if not limit and not sample and size > MAX_EXPAND_SIZE:
+            continue
+        ranged += min(size, sample) if sample else size
+    scale = os.path.getsize(file_path) / max(1, len(head))
+    plain, ranged = int(plain * scale), int(ranged * scale)
+    return plain + (min(ranged, limit) if limit else ranged)
+
+def plan_execution(source, memory_budget_mb=None, expand=None):
+    """根据输入大小、格式、可用内存和CPU数选择执行方式，返回执行计划
+    
+    memory_budget_mb: 内存预算(MB)，默认取可用内存的一半
+    expand: 展开CIDR/IP段的设置，按文件开头的地址段大小估计展开后的行数
+    """
+    file_format = sniff_input_format(source)
+    size = os.path.getsize(source) if file_format != 'stdin' else None
+    available = available_memory()
+    if memory_budget_mb:
+        budget = memory_budget_mb << 20
+    else:
+        budget = available // 2 if available else DEFAULT_MEMORY_BUDGET
+    cpus = os.cpu_count() or 1
+    plan = {'engine': 'memory', 'format': file_format, 'size': size, 'budget': budget, 'available': available,
+            'cpus': cpus, 'workers': 1, 'chunk_rows': PLAN_MIN_CHUNK_ROWS, 'run_rows': 0, 'reason': ''}
+    
+    # 每块占用预算的 1/16；外部排序每段占用预算的 1/4
+    if size is not None and file_format in ['text', 'csv']:
+        row_bytes = sample_line_length(source) * MEMORY_FACTORS[file_format]
+    else:
+        row_bytes = 64 * MEMORY_FACTORS['text']
+    plan['chunk_rows'] = min(PLAN_MAX_CHUNK_ROWS, max(PLAN_MIN_CHUNK_ROWS, budget // 16 // row_bytes))
+    plan['run_rows'] = max(PLAN_MIN_CHUNK_ROWS, budget // 4 // RECORD_BYTES)
+    
+    estimate = size * MEMORY_FACTORS[file_format] if size is not None else None
+    if expand is not None and file_format == 'text':
+        estimate = estimate_expanded_rows(source, expand) * RECORD_BYTES
+    
+    if file_format in ['excel', 'columnar', 'special']:
+        plan['reason'] = {'excel': 'Excel 只能整体读取', 'columnar': '列式文件内存映射读取',
+                          'special': '链接文件整体解析'}[file_format]
+    elif file_format == 'stdin':
+        plan['engine'], plan['reason'] = 'chunked', '输入大小未知，逐块读取'
+    elif estimate <= budget // 4:
+        plan['reason'] = '输入较小，整体读入最快'
+    elif estimate > budget:
+        plan['engine'], plan['reason'] = 'external', f"预计占用 {format_bytes(estimate)} 超过预算"
+    elif cpus > 1 and size >= PARALLEL_MIN_SIZE:
+        plan['engine'], plan['reason'] = 'parallel', '输入较大且有多个CPU'
+        plan['workers'] = min(cpus, PARALLEL_MAX_WORKERS)
+    else:
+        plan['engine'], plan['reason'] = 'chunked', '分块读取，控制峰值内存'
+    return plan
+
+def describe_plan(plan):
+    """执行计划的一行描述"""
+    parts = [f"{EXECUTION_ENGINES[plan['engine']]}（{plan['reason']}）"]
+    size_text = format_bytes(plan['size']) + " " if plan['size'] is not None else ""
+    parts.append(f"输入 {size_text}{INPUT_FORMAT_NAMES[plan['format']]}")
+    parts.append(f"内存预算 {format_bytes(plan['budget'])}" +
+                 (f"（可用 {format_bytes(plan['available'])}）" if plan['available'] else ""))
+    parts.append(f"{plan['cpus']} CPU")
+    if plan['engine'] == 'parallel':
+        parts.append(f"{plan['workers']} 个进程")
+    if plan['engine'] != 'memory':
+        parts.append(f"每块 {plan['chunk_rows']} 行")
+    return " | ".join(parts)
+
+class ChunkSizer:
+    """按观测到的常驻内存调整块大小：超过预算的 3/4 时减半，低于 1/4 时加倍"""
+    
+    def __init__(self, rows, budget):
+        self.rows = rows
+        self.budget = budget
+        self.peak = 0
+        self.adjustments = 0
+    
+    def over_budget(self):
+        """常驻内存是否已超过预算的 3/4"""
+        rss = current_rss()
+        if rss is None:
+            return False
+        self.peak = max(self.peak, rss)
+        return rss > self.budget * 3 // 4
+    
+    def next_rows(self):
+        """读取下一块前调用，返回下一块的行数"""
+        rss = current_rss()
+        if rss is None:
+            return self.rows
+        self.peak = max(self.peak, rss)
+        if rss > self.budget * 3 // 4 and self.rows > PLAN_MIN_CHUNK_ROWS:
+            self.rows = max(PLAN_MIN_CHUNK_ROWS, self.rows // 2)
+            self.adjustments += 1
+        elif rss < self.budget // 4 and self.rows < PLAN_MAX_CHUNK_ROWS:
+            self.rows = min(PLAN_MAX_CHUNK_ROWS, self.rows * 2)
+            self.adjustments += 1
+        return self.rows
+
+def external_sort_key(line):
+    """外部排序键：结果行排序键之后按文本排序，使相同的行相邻"""
+    return result_sort_key(line), line
+
+class SortedRuns:
+    """外部排序的记录：每段按规范记录行排序后写入临时目录，归并读出时相同的行只输出一次，可多次读出为 Record"""
+    
+    def __init__(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='ip_tool_runs_')
+        self.paths = []
+        self.written = 0
+    
+    def __bool__(self):
+        return bool(self.paths)
+    
+    def __iter__(self):
+        return (Record.from_line(line) for line in self.merge(self.paths))
+    
+    def add(self, records):
+        """格式化为规范记录行，排序后写入一个临时文件；临时文件过多时全部归并为一个"""
+        if not records:
+            return
+        lines = [record.format(RECORD_MODE) for record in records]
+        self.paths.append(self.write_run(sorted(lines, key=external_sort_key)))
+        if len(self.paths) >= EXTERNAL_MAX_RUNS:
+            paths, self.paths = self.paths, []
+            self.paths.append(self.write_run(self.merge(paths)))
+            for path in paths:
+                os.remove(path)
+    
+    def write_run(self, lines):
+        path = os.path.join(self.temp_dir, f"run_{self.written}.txt")
+        self.written += 1
+        with open(path, 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line + '\n')
+        return path
+    
+    @staticmethod
+    def merge(paths):
+        previous = None
+        for line in heapq.merge(*[iter_result_lines(path) for path in paths], key=external_sort_key):
+            if line != previous:
+                previous = line
+                yield line
+    
+    def close(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+def iter_plan_chunks(source, plan, sizer, expand=None):
+    """按计划分块读取输入：文本块为行列表，CSV块为DataFrame；每读一块前按常驻内存调整块大小"""
+    if plan['format'] == 'csv':
+        encoding = sniff_csv_encoding(source)
+        print(f"✅ 分块读取CSV文件({encoding})")
+        reader = pd.read_csv(source, encoding=encoding, encoding_errors='replace', chunksize=sizer.rows)
+        with reader:
+            while True:
+                try:
+                    yield reader.get_chunk(sizer.next_rows())
+                except StopIteration:
+                    return
+    
+    handle = source if plan['format'] == 'stdin' else open(source, 'r', encoding='utf-8', errors='ignore')
+    try:
+        lines = handle if expand is None else iter_expand_lines(handle, expand.get('limit'), expand.get('sample'))
+        while True:
+            chunk = list(itertools.islice(lines, sizer.next_rows()))
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        if handle is not source:
+            handle.close()
+
+def iter_chunk_endpoints(chunk, extract_mode, default_port="", where=None, validator=None, columns=None):
+    """提取一块输入的端点：文本块逐行提取并过滤，表格块（已过滤）按检测好的列提取"""
+    if isinstance(chunk, pd.DataFrame):
+        return iter_frame_endpoints(chunk, extract_mode, default_port, validator, columns)
+    return iter_text_endpoints(chunk, extract_mode, default_port, where, validator)
+
+def extract_chunk_worker(task):
+    """并行工作进程：重建过滤条件和校验器后提取一块输入，返回 (端点列表, 校验排除统计, 过滤排除数)"""
+    chunk, extract_mode, default_port, where_spec, drop, columns = task
+    where = None
+    if where_spec:
+        where = compile_where(where_spec[0])
+        where.annotations = where_spec[1]
+    validator = EndpointValidator(drop)
+    endpoints = list(iter_chunk_endpoints(chunk, extract_mode, default_port, where, validator, columns))
+    return endpoints, validator.rejected, where.rejected if where else 0
+
+def run_plan(plan, source, extract_mode=RECORD_MODE, default_port="", where=None, seen=None, validator=None,
+             expand=None, annotations=None, tag=None):
+    """按 chunked/parallel/external 计划分块提取，返回 Record 列表（external 返回排好序的 SortedRuns），失败返回None
+    
+    端点在主进程中逐块转为 Record 并去重、添加注释；
+    external 计划不使用精确去重集合（相同的行在归并时去掉）
+    """
+    validator = EndpointValidator() if validator is None else validator
+    sizer = ChunkSizer(plan['chunk_rows'], plan['budget'])
+    plan['sizer'] = sizer
+    external = plan['engine'] == 'external'
+    if external and not isinstance(seen, ApproxSeenSet):
+        seen = None
+    results = SortedRuns() if external else []
+    buffer = []
+    
+    def collect(endpoints):
+        records = iter_endpoint_records(endpoints, extract_mode, seen, annotations, tag)
+        if not external:
+            results.extend(records)
+            return
+        buffer.extend(records)
+        if len(buffer) >= plan['run_rows'] or sizer.over_budget():
+            results.add(buffer)
+            buffer.clear()
+    
+    def tasks():
+        # 表格块在主进程过滤（向量化），IP列只在第一块检测一次
+        columns = None
+        for chunk in iter_plan_chunks(source, plan, sizer, expand):
+            if isinstance(chunk, pd.DataFrame):
+                if columns is None:
+                    columns = detect_frame_columns(chunk, extract_mode)
+                    if not columns[0]:
+                        raise ValueError("无法自动检测IP列")
+                yield (where.filter_frame(chunk) if where else chunk), columns
+            else:
+                yield chunk, None
+    
+    try:
+        if plan['engine'] == 'parallel':
+            where_spec = (where.expression, where.annotations) if where else None
+            executor = concurrent.futures.ProcessPoolExecutor(plan['workers'])
+            pending = deque()
+            
+            def fall_back(e):
+                # 工作进程无法启动或异常退出时，未完成的块和之后的块改在主进程中提取
+                nonlocal executor
+                if executor is not None:
+                    print(f"⚠️  并行进程不可用({e})，改为分块流式处理")
+                    executor.shutdown(wait=False)
+                    executor = None
+                    plan['engine'] = 'chunked'
+            
+            def submit(task):
+                if executor is not None:
+                    try:
+                        return executor.submit(extract_chunk_worker, task)
+                    except BrokenProcessPool as e:
+                        fall_back(e)
+                return None
+            
+            def finish(future, task):
+                try:
+                    result = future.result() if future is not None else extract_chunk_worker(task)
+                except BrokenProcessPool as e:
+                    fall_back(e)
+                    result = extract_chunk_worker(task)
+                endpoints, rejected, where_rejected = result
+                for reason, count in rejected.items():
+                    validator.reject(reason, count)
+                if where:
+                    where.rejected += where_rejected
+                collect(endpoints)
+            
+            try:
+                # 同时提交的块数有上限，读取不会远远领先于提取
+                for chunk, columns in tasks():
+                    task_where = where_spec if columns is None else None
+                    task = (chunk, extract_mode, default_port, task_where, validator.drop, columns)
+                    pending.append((submit(task), task))
+                    if len(pending) >= plan['workers'] * 2:
+                        finish(*pending.popleft())
+                while pending:
+                    finish(*pending.popleft())
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+        else:
+            for chunk, columns in tasks():
+                collect(iter_chunk_endpoints(chunk, extract_mode, default_port, where if columns is None else None, validator, columns))
+        if external:
+            results.add(buffer)
+    except Exception as e:
+        print(f"❌ 分块处理失败: {e}")
+        if external:
+            results.close()
+        return None
+    
+    return results
+
+def print_plan_summary(plan):
+    """运行结束后输出执行方式和内存观测"""
+    sizer = plan.get('sizer')
+    if sizer is None:
+        print(f"🧭 执行方式: {EXECUTION_ENGINES[plan['engine']]}")
+        return
+    peak = f"，峰值内存 {format_bytes(sizer.peak)}" if sizer.peak else ""
+    print(f"🧭 执行方式: {EXECUTION_ENGINES[plan['engine']]}{peak}，块大小调整 {sizer.adjustments} 次（最终每块 {sizer.rows} 行）")
+
+def iter_render_sorted(records, extract_mode):
+    """将有序的 Record 逐条格式化；格式化后相同的行必然相邻，只输出一次"""
+    previous = None
+    for record in records:
+        result_item = record.format(extract_mode)
+        if result_item is None or result_item == previous:
+            continue
+        previous = result_item
+        yield result_item
+
+def write_sorted_outputs(runs, outputs, record_port="", port=None, dedup_key='line', keep='first', approx=None, link_template=None):
+    """外部排序的结果按每个输出模式边归并边格式化写出；
+    CIDR 聚合、按端点去重、列式输出，或默认端口与提取时不同（补端口后顺序会变）时读回内存按常规方式输出"""
+    for mode, out in outputs:
+        extract_mode = CLI_MODES[mode]
+        if extract_mode == "cidr" or dedup_key != 'line' or get_columnar_format(out) or cli_default_port(mode, port) != record_port:
+            write_mode_outputs(list(runs), [(mode, out)], port, dedup_key, keep, approx, link_template)
+            continue
+        
+        # 归并出的记录已去重，按模板生成链接时无需再去重
+        if extract_mode in LINK_MODES:
+            write_link_output(runs, mode, out, link_template)
+            continue
+        
+        lines = iter_render_sorted(runs, extract_mode)
+        first = next(lines, None)
+        if first is None:
+            print(f"❌ {mode}: 未提取到任何有效数据")
+            continue
+        
+        try:
+            count, location = write_output(itertools.chain([first], lines), out)
+            print(f"✅ {mode} 处理完成！共生成 {count} 条去重记录")
+            print(f"💾 输出文件: {location}")
+        except Exception as e:
+            print(f"❌ 保存文件失败: {e}")
+
 def command_line_mode():
     """命令行模式"""
     program_name = os.path.basename(sys.argv[0])
     parser = argparse.ArgumentParser(description=f'{program_name} - IP处理工具', add_help=False)
     parser.add_argument('-u', '--usage', action='store_true', help='显示使用说明')
     parser.add_argument('-f', '--file', type=str, help='输入文件路径')
-    parser.add_argument('-m', '--mode', type=str, choices=['ipportremark', 'ipspace', 'iponly'], 
-                       default='ipspace', help='输出模式 (默认: ipspace)')
-    parser.add_argument('-o', '--out', type=str, default='results.txt', help='输出文件名')
-    parser.add_argument('-p', '--port', type=int, default=443, help='默认端口号')
+    parser.add_argument('-m', '--mode', type=str, nargs='+', choices=list(CLI_MODES), 
+                       default=['ipspace'], help='输出模式，可指定多个 (默认: ipspace)')
+    parser.add_argument('-o', '--out', type=str, nargs='+', default=['results.txt'], help='输出文件名，与 -m 一一对应')
+    parser.add_argument('-p', '--port', type=int, default=None, help='默认端口号')
+    parser.add_argument('-e', '--expand', action='store_true', help='展开CIDR/IP段')
+    parser.add_argument('--limit', type=int, default=None, help='展开的IP总数上限')
+    parser.add_argument('--sample', type=int, default=None, help='每个地址段随机抽样数量')
+    parser.add_argument('-w', '--where', type=str, default=None, help='过滤条件')
+    parser.add_argument('--dedup-key', type=str, choices=['line', 'ipport', 'ip'], default='line', help='去重依据')
+    parser.add_argument('--keep', type=str, choices=DEDUP_POLICIES, default='first', help='重复时保留的行')
+    parser.add_argument('--approx-dedup', action='store_true', help='使用近似去重（内存固定）')
+    parser.add_argument('--fp-rate', type=float, default=0.001, help='近似去重的目标误判率')
+    parser.add_argument('--dedup-memory', type=int, default=64, help='近似去重的内存预算(MB)')
+    parser.add_argument('-j', '--job', type=str, help='执行 JSON/TOML 任务文件（无交互自定义模式）')
+    parser.add_argument('--drop', type=str, nargs='+', choices=DROP_CATEGORIES, default=[], help='丢弃的地址类别')
+    parser.add_argument('--annotate', type=str, default=None, help='离线IP段数据库(CSV或编译好的.idx目录)')
+    parser.add_argument('--tag', type=str, default=None, help='注释标签模板，如 "[country] [asn]"')
+    parser.add_argument('--memory-budget', type=int, default=None, help='内存预算(MB)，默认为可用内存的一半')
+    parser.add_argument('--link-template', type=str, default=None, help='link/sub 模式的链接模板（链接或包含链接的文件）')
     
     args = parser.parse_args()
     
+    if args.job:
+        run_job_file(args.job)
+        return
+    
     if args.usage or not args.file:
         show_usage()
         return
     
-    if not os.path.exists(args.file):
+    # -f - 表示从标准输入读取文本
+    is_stdin = args.file == '-'
+    if not is_stdin and not os.path.exists(args.file):
         print(f"❌ 文件不存在: {args.file}")
         return
     
-    # 映射模式参数
-    mode_map = {
-        'ipportremark': 'ip_port_remark',
-        'ipspace': 'ip_space_port',
-        'iponly': 'ip_only'
-    }
+    outputs = pair_mode_outputs(args.mode, args.out)
+    if outputs is None:
+        return
+    
+    # -o - 时结果写到标准输出，提示信息改写到标准错误，便于直接管道给订阅服务
+    if any(out == '-' for _, out in outputs):
+        sys.stdout = sys.stderr
+    
+    # link/sub 模式的链接模板：未指定时使用输入链接文件中的第一条链接
+    link_template = None
+    if any(CLI_MODES[mode] in LINK_MODES for mode in args.mode):
+        try:
+            template_source = args.file if not is_stdin and is_special_format_file(args.file) else None
+            link_template = load_link_template(args.link_template, template_source)
+        except (ValueError, UnicodeDecodeError) as e:
+            print(f"❌ 链接模板错误: {e}")
+            return
+        if link_template is None:
+            print("❌ link/sub 模式需要 --link-template（链接或包含链接的文件）")
+            return
+    
+    def mode_default_port(mode):
+        return cli_default_port(mode, args.port)
+    
+    expand = {'limit': args.limit, 'sample': args.sample} if args.expand else None
     
-    extract_mode = mode_map[args.mode]
+    # 加载注释索引（首次使用时编译，之后内存映射加载）
+    annotations = None
+    if args.annotate:
+        try:
+            annotations = load_annotation_index(args.annotate)
+        except Exception as e:
+            print(f"❌ 注释数据库加载失败: {e}")
+            return
+    
+    # 编译过滤条件（文本类输入只支持 ip/port/remark 字段，以及注释字段）
+    try:
+        where = compile_where(args.where)
+        if where:
+            where.annotations = annotations
+        if where and (is_stdin or is_special_format_file(args.file) or os.path.splitext(args.file)[1].lower() == '.txt'):
+            where.check_text_fields()
+    except WhereError as e:
+        print(f"❌ 过滤条件错误: {e}")
+        return
     
     print(f"🔧 命令行模式:")
     print(f"   输入文件: {args.file}")
-    print(f"   输出模式: {args.mode}")
-    print(f"   输出文件: {args.out}")
-    print(f"   默认端口: {args.port}")
+    print(f"   输出模式: {' '.join(args.mode)}")
+    print(f"   输出文件: {' '.join(out for _, out in outputs)}")
+    print(f"   默认端口: {' '.join(mode_default_port(mode) or '无' for mode in args.mode)}")
+    if where:
+        print(f"   过滤条件: {args.where}")
     
-    # 检测是否为特殊格式文件
-    if is_special_format_file(args.file):
-        if args.mode == 'ipportremark':
-            results = extract_special_format(args.file)
-        elif args.mode == 'ipspace':
-            special_results = extract_special_format(args.file)
-            results = []
-            for item in special_results:
-                match = re.match(r'([^:]+):(\d+)(#.*)?', item)
-                if match:
-                    results.append(f"{match.group(1)} {match.group(2)}")
-        elif args.mode == 'iponly':
-            special_results = extract_special_format(args.file)
-            results = []
-            for item in special_results:
-                match = re.match(r'([^:]+):(\d+)(#.*)?', item)
-                if match:
-                    results.append(match.group(1))
+    # 去重集合：默认精确 set，--approx-dedup 时使用布隆过滤器，内存不随记录数增长
+    approx = {'fp_rate': args.fp_rate, 'memory_mb': args.dedup_memory} if args.approx_dedup else None
+    seen = new_seen_set(approx)
+    if args.approx_dedup:
+        print(f"   近似去重: 误判率 {args.fp_rate}，内存预算 {args.dedup_memory}MB")
+    
+    # 校验阶段：IP八位组和端口按整数校验并规范化，可丢弃私有/保留/bogon地址
+    validator = EndpointValidator(args.drop)
+    if args.drop:
+        print(f"   丢弃地址: {' '.join(args.drop)}")
+    
+    if is_stdin and len(outputs) == 1:
+        mode, out = outputs[0]
+        extract_mode = CLI_MODES[mode]
+        if extract_mode not in ["cidr"] + LINK_MODES and args.dedup_key == 'line' and not get_columnar_format(out) and not annotations and out != '-':
+            stream_lines_to_file(sys.stdin, get_safe_output_path(out), extract_mode, mode_default_port(mode), where, seen, validator, expand)
+            return
+    
+    # 只提取一次，得到规范记录（IP:端口#备注，端口可缺省），再按每个输出模式格式化
+    # 各模式默认端口相同时提取阶段就补上，过滤条件中的 port 与单模式时一致
+    default_ports = {mode_default_port(mode) for mode in args.mode}
+    record_port = default_ports.pop() if len(default_ports) == 1 else ""
+    
+    # 按输入大小、格式、可用内存和CPU数选择执行方式：小文件整体读入，大文件分块/并行，超出内存预算时外部排序
+    source = sys.stdin if is_stdin else args.file
+    plan = plan_execution(source, args.memory_budget, expand)
+    print(f"   执行计划: {describe_plan(plan)}")
+    sheets = None
+    if not is_stdin and os.path.splitext(args.file)[1].lower() in ['.xlsx', '.xls']:
+        try:
+            sheets = ask_excel_sheets(args.file)
+        except Exception as e:
+            print(f"❌ Excel文件读取失败: {e}")
+            return
+        if not sheets:
+            return
+    if plan['engine'] == 'memory':
+        try:
+            records = list(iter_records(source, RECORD_MODE, record_port, where, annotate=annotations, tag=args.tag,
+                                        expand=expand, sheets=sheets, validator=validator, seen=seen))
+        except Exception as e:
+            print(f"❌ 处理文件失败: {e}")
+            return
     else:
-        # 普通文件处理
-        file_ext = os.path.splitext(args.file)[1].lower()
-        
-        if file_ext in ['.xlsx', '.xls']:
-            dfs_dict = process_excel_file(args.file, selected_sheets=None)
-            if not dfs_dict:
-                return
-            results = []
-            for sheet_name, df in dfs_dict.items():
-                sheet_results = process_dataframe_for_quick_mode(df, extract_mode, str(args.port))
-                if sheet_results:
-                    results.extend(sheet_results)
-        elif file_ext in ['.txt']:
-            results = extract_from_text_advanced(args.file, extract_mode, str(args.port))
-        else:
-            df = process_csv_file(args.file)
-            if df is None:
-                return
-            results = process_dataframe_for_quick_mode(df, extract_mode, str(args.port))
+        records = run_plan(plan, source, RECORD_MODE, record_port, where, seen, validator, expand, annotations, args.tag)
+    if records is None:
+        return
+    
+    print_validation_summary(validator)
+    if where:
+        print(f"🔎 过滤条件排除了 {where.rejected} 条记录")
+    print_dedup_summary(seen)
+    print_plan_summary(plan)
     
-    if not results:
+    if not records:
         print("❌ 未提取到任何有效数据")
         return
     
-    # 保存结果
-    output_path = get_safe_output_path(args.out)
-    try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for line in results:
-                f.write(line + '\n')
+    # 注释在提取时写入备注（ipportremark 模式输出）
+    if annotations:
+        print(f"🏷️  已按 {args.annotate} 添加注释: {', '.join(annotations.fields)}")
+    
+    # 外部排序的结果归并时边格式化边写出
+    if isinstance(records, SortedRuns):
+        try:
+            write_sorted_outputs(records, outputs, record_port, args.port, args.dedup_key, args.keep, approx, link_template)
+        finally:
+            records.close()
+        return
+    
+    write_mode_outputs(records, outputs, args.port, args.dedup_key, args.keep, approx, link_template)
+
+# 命令行模式参数 → 提取模式
+CLI_MODES = {
+    'ipportremark': 'ip_port_remark',
+    'ipspace': 'ip_space_port',
+    'iponly': 'ip_only',
+    'cidr': 'cidr',
+    'link': 'link',
+    'sub': 'subscription'
+}
+# 按链接模板生成节点链接的输出模式：link 每行一条链接，subscription 整体 base64 编码（订阅格式）
+LINK_MODES = ['link', 'subscription']
+
+def pair_mode_outputs(modes, outs):
+    """多个输出模式对应多个输出文件；只给一个文件名时按模式名自动区分，数量不一致返回None"""
+    if len(outs) == len(modes):
+        return list(zip(modes, outs))
+    if len(outs) == 1:
+        stem, ext = os.path.splitext(outs[0])
+        return [(mode, f"{stem}_{mode}{ext}") for mode in modes]
+    print(f"❌ 输出文件数量({len(outs)})与输出模式数量({len(modes)})不一致")
+    return None
+
+def cli_default_port(mode, port=None):
+    """命令行模式的默认端口：-p 指定时使用指定值，否则 CIDR 聚合不添加，其他模式为 443"""
+    return str(port) if port is not None else ("" if mode == "cidr" else "443")
+
+def write_mode_outputs(records, outputs, port=None, dedup_key='line', keep='first', approx=None, link_template=None):
+    """将 Record 按每个 (输出模式, 输出文件) 格式化、去重后写出；记录不需要预先排序，输出按 IP、端口排序"""
+    for mode, out in outputs:
+        extract_mode = CLI_MODES[mode]
+        if extract_mode in LINK_MODES:
+            mode_records = sorted(records, key=lambda record: record.sort_key)
+            if dedup_key != 'line':
+                mode_records = dedup_records_by_endpoint(mode_records, keep, dedup_key)
+            write_link_output(mode_records, mode, out, link_template, cli_default_port(mode, port), new_seen_set(approx))
+            continue
         
-        valid_count = len([line for line in results if not line.startswith('-----')])
-        print(f"✅ 处理完成！共生成 {valid_count} 条去重记录")
-        print(f"💾 输出文件: {output_path}")
+        results = render_records(records, extract_mode, cli_default_port(mode, port), new_seen_set(approx))
+        
+        if dedup_key != 'line' and results:
+            results = dedup_lines_by_endpoint(results, keep, dedup_key)
         
+        if extract_mode == "cidr" and results:
+            results = collapse_results_to_cidr(results)
+        
+        if not results:
+            print(f"❌ {mode}: 未提取到任何有效数据")
+            continue
+        
+        # 保存结果
+        try:
+            _, location = write_output(results, out)
+            
+            valid_count = len([line for line in results if not line.startswith('-----')])
+            print(f"✅ {mode} 处理完成！共生成 {valid_count} 条去重记录")
+            print(f"💾 输出文件: {location}")
+            
+        except Exception as e:
+            print(f"❌ 保存文件失败: {e}")
+
+def write_output(lines, out, base64_encode=False):
+    """写出结果到文件，out 为 '-' 时写到标准输出；返回 (行数, 输出位置)"""
+    if out == '-':
+        return write_stdout_lines(lines, base64_encode), "标准输出"
+    output_path = get_safe_output_path(out)
+    return write_results_file(lines, output_path, base64_encode=base64_encode), output_path
+
+def iter_links(records, link_template, default_port="", seen=None):
+    """将 Record 按链接模板逐条生成节点链接（生成器）；seen 为None时不去重（记录已去重时使用）"""
+    for record in records:
+        endpoint = record.format("ip_port_remark", default_port)
+        if endpoint is None:
+            continue
+        if seen is not None:
+            if endpoint in seen:
+                continue
+            seen.add(endpoint)
+        yield link_template.render(record.address, str(record.port) if record.port else default_port, record.remark)
+
+def write_link_output(records, mode, out, link_template, default_port="", seen=None):
+    """按链接模板生成节点链接并写出：link 每行一条，sub 边生成边 base64 编码，订阅内容不会整体留在内存中"""
+    if link_template is None:
+        print(f"❌ {mode}: 需要链接模板（--link-template），或输入为链接文件")
+        return
+    if get_columnar_format(out):
+        print(f"❌ {mode}: 链接输出不支持列式文件")
+        return
+    
+    links = iter_links(records, link_template, default_port, seen)
+    first = next(links, None)
+    if first is None:
+        print(f"❌ {mode}: 未提取到任何有效数据")
+        return
+    
+    try:
+        count, location = write_output(itertools.chain([first], links), out, CLI_MODES[mode] == 'subscription')
+        print(f"✅ {mode} 处理完成！共生成 {count} 条{link_template.scheme}链接" +
+              ("（base64 订阅格式）" if CLI_MODES[mode] == 'subscription' else ""))
+        print(f"💾 输出文件: {location}")
     except Exception as e:
         print(f"❌ 保存文件失败: {e}")
 
+# ---- 监视模式 ----
+WATCH_EXTENSIONS = {'.txt', '.csv', '.xlsx', '.xls'} | set(COLUMNAR_FORMATS)
+WATCH_TABLE_EXTENSIONS = WATCH_EXTENSIONS - {'.txt'}
+# inotify 事件：写入、写完关闭、新建、移入、删除、移出
+INOTIFY_MASK = 0x002 | 0x008 | 0x100 | 0x080 | 0x200 | 0x040
+
+def open_inotify(directories):
+    """Linux 下通过 ctypes 使用 inotify 监视目录，不可用时返回None（改为轮询）"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        for directory in directories:
+            if libc.inotify_add_watch(fd, os.fsencode(directory), INOTIFY_MASK) < 0:
+                os.close(fd)
+                return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+def wait_for_events(fd, timeout):
+    """等待 inotify 事件并读空缓冲区，有事件返回True"""
+    import select
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if not readable:
+        return False
+    try:
+        while os.read(fd, 65536):
+            pass
+    except BlockingIOError:
+        pass
+    return True
+
+def snapshot_watch_paths(paths, ignored):
+    """列出监视的文件及其 (inode, 大小, 修改时间)；目录只看第一层中支持的文件，跳过输出文件和隐藏的临时文件"""
+    files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, name) for name in os.listdir(path)
+                          if not name.startswith('.') and os.path.splitext(name)[1].lower() in WATCH_EXTENSIONS]
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            candidate = os.path.abspath(candidate)
+            if candidate in ignored:
+                continue
+            try:
+                stat = os.stat(candidate)
+            except OSError:
+                continue
+            if os.path.isfile(candidate):
+                files[candidate] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    return files
+
+class IncrementalExtractor:
+    """按文件记录已处理的位置：文本文件只处理追加的完整行，被截断或替换时整体重新处理；表格文件变化时整体重新处理"""
+    
+    def __init__(self, record_port="", where=None, validator=None, annotations=None, tag=None):
+        self.record_port = record_port
+        self.where = where
+        self.validator = validator
+        self.annotations = annotations
+        self.tag = tag
+        self.state = {}  # 路径 -> {'inode', 'offset', 'special', 'seen', 'records'}
+    
+    def records(self):
+        """所有文件的 Record"""
+        return [record for state in self.state.values() for record in state['records']]
+    
+    def remove(self, path):
+        self.state.pop(path, None)
+    
+    def update(self, path, stat):
+        """处理一个有变化的文件，返回新增记录数"""
+        inode, size, _ = stat
+        state = self.state.get(path)
+        is_text = os.path.splitext(path)[1].lower() not in WATCH_TABLE_EXTENSIONS
+        if is_text and self.where:
+            # 过滤条件使用表格列时，同一目录中的文本文件无法应用，跳过
+            try:
+                self.where.check_text_fields()
+            except WhereError as e:
+                print(f"⚠️  跳过 {os.path.basename(path)}: {e}")
+                self.remove(path)
+                return 0
+        if state is None or not is_text or state['inode'] != inode or size < state['offset']:
+            state = {'inode': inode, 'offset': 0, 'special': is_text and is_special_format_file(path),
+                     'seen': set(), 'records': []}
+            self.state[path] = state
+        
+        if is_text:
+            with open(path, 'rb') as f:
+                f.seek(state['offset'])
+                data = f.read()
+            # 只处理到最后一个换行符，写了一半的行留到下次
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                return 0
+            state['offset'] += end
+            lines = data[:end].decode('utf-8', errors='ignore').splitlines()
+            if state['special']:
+                endpoints = iter_special_endpoints(lines, self.where, self.validator)
+            else:
+                endpoints = iter_text_endpoints(lines, RECORD_MODE, self.record_port, self.where, self.validator)
+        else:
+            endpoints = iter_source_endpoints(path, RECORD_MODE, self.record_port, self.where, self.validator)
+        
+        new_records = list(iter_endpoint_records(endpoints, RECORD_MODE, state['seen'], self.annotations, self.tag))
+        state['records'].extend(new_records)
+        return len(new_records)
+
+def watch_mode(argv):
+    """watch 子命令：监视文件或目录，输入变化时增量提取并原子地重写输出"""
+    parser = argparse.ArgumentParser(prog='watch', description='监视输入并自动更新输出', add_help=False)
+    parser.add_argument('paths', nargs='+', help='监视的文件或目录')
+    parser.add_argument('-m', '--mode', type=str, nargs='+', choices=list(CLI_MODES), default=['ipspace'], help='输出模式')
+    parser.add_argument('-o', '--out', type=str, nargs='+', default=['results.txt'], help='输出文件名')
+    parser.add_argument('-p', '--port', type=int, default=None, help='默认端口号')
+    parser.add_argument('-w', '--where', type=str, default=None, help='过滤条件')
+    parser.add_argument('--dedup-key', type=str, choices=['line', 'ipport', 'ip'], default='line', help='去重依据')
+    parser.add_argument('--keep', type=str, choices=DEDUP_POLICIES, default='first', help='重复时保留的行')
+    parser.add_argument('--drop', type=str, nargs='+', choices=DROP_CATEGORIES, default=[], help='丢弃的地址类别')
+    parser.add_argument('--annotate', type=str, default=None, help='离线IP段数据库')
+    parser.add_argument('--tag', type=str, default=None, help='注释标签模板')
+    parser.add_argument('--link-template', type=str, default=None, help='link/sub 模式的链接模板')
+    parser.add_argument('-j', '--job', type=str, default=None, help='输入变化时重新运行相关的任务')
+    parser.add_argument('--interval', type=float, default=1.0, help='轮询间隔(秒)')
+    parser.add_argument('--debounce', type=float, default=0.5, help='变化平静多久后再处理(秒)')
+    parser.add_argument('--poll', action='store_true', help='不使用 inotify，强制轮询')
+    args = parser.parse_args(argv)
+    
+    for path in args.paths:
+        if not os.path.exists(path):
+            print(f"❌ 文件不存在: {path}")
+            return
+    
+    outputs = pair_mode_outputs(args.mode, args.out)
+    if outputs is None:
+        return
+    ignored = {get_safe_output_path(out) for _, out in outputs}
+    if args.job:
+        try:
+            ignored |= {get_safe_output_path(job.get('output', 'custom_results')) for job in load_job_file(args.job)}
+        except Exception as e:
+            print(f"❌ 任务文件读取失败: {e}")
+            return
+    
+    try:
+        annotations = load_annotation_index(args.annotate) if args.annotate else None
+        where = compile_where(args.where)
+        if where:
+            where.annotations = annotations
+        # 只监视文本或链接文件时提前检查过滤字段；含表格或目录时表格可以使用任意列
+        if where and all(os.path.isfile(path) and os.path.splitext(path)[1].lower() not in WATCH_TABLE_EXTENSIONS
+                         for path in args.paths):
+            where.check_text_fields()
+        # link/sub 模式未指定链接模板时使用监视的第一个链接文件中的链接
+        link_template = None
+        if any(CLI_MODES[mode] in LINK_MODES for mode in args.mode):
+            link_files = [path for path in args.paths if os.path.isfile(path) and is_special_format_file(path)]
+            link_template = load_link_template(args.link_template, link_files[0] if link_files else None)
+            if link_template is None:
+                raise ValueError("link/sub 模式需要 --link-template")
+    except Exception as e:
+        print(f"❌ 参数错误: {e}")
+        return
+    
+    default_ports = {cli_default_port(mode, args.port) for mode in args.mode}
+    extractor = IncrementalExtractor(default_ports.pop() if len(default_ports) == 1 else "",
+                                     where, EndpointValidator(args.drop), annotations, args.tag)
+    
+    directories = sorted({os.path.abspath(path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path)))
+                          for path in args.paths})
+    fd = None if args.poll else open_inotify(directories)
+    print(f"👀 正在监视: {', '.join(args.paths)}（{'inotify' if fd is not None else f'每 {args.interval} 秒轮询'}，Ctrl+C 退出）")
+    
+    known = {}
+    try:
+        while True:
+            current = snapshot_watch_paths(args.paths, ignored)
+            changed = {path for path, stat in current.items() if known.get(path) != stat}
+            removed = set(known) - set(current)
+            
+            if changed or removed:
+                # 防抖：等文件在 debounce 秒内不再变化，一连串写入只触发一次重建
+                while True:
+                    time.sleep(args.debounce)
+                    settled = snapshot_watch_paths(args.paths, ignored)
+                    if settled == current:
+                        break
+                    current = settled
+                changed = {path for path, stat in current.items() if known.get(path) != stat}
+                removed = set(known) - set(current)
+                known = current
+                
+                print(f"\n🔄 {time.strftime('%H:%M:%S')} 检测到变化: {', '.join(os.path.basename(path) for path in sorted(changed | removed))}")
+                if args.job:
+                    run_job_file(args.job, changed | removed)
+                else:
+                    for path in removed:
+                        extractor.remove(path)
+                    added = 0
+                    for path in sorted(changed):
+                        try:
+                            added += extractor.update(path, current[path])
+                        except Exception as e:
+                            print(f"❌ 处理文件失败 {os.path.basename(path)}: {e}")
+                    print(f"➕ 新增 {added} 条记录")
+                    print_validation_summary(extractor.validator)
+                    records = extractor.records()
+                    if records:
+                        write_mode_outputs(records, outputs, args.port, args.dedup_key, args.keep, link_template=link_template)
+            
+            if fd is not None:
+                wait_for_events(fd, None)
+            else:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("\n⏹️  已停止监视")
+    finally:
+        if fd is not None:
+            os.close(fd)
+
 def main():
     """主函数"""
+    set_working_directory()
+    setup_console_logging()
     try:
+        # 集合运算子命令
+        if len(sys.argv) > 1 and sys.argv[1] == 'setop' and not os.path.exists(sys.argv[1]):
+            setop_mode(sys.argv[2:])
+            return
+        
+        # 监视子命令
+        if len(sys.argv) > 1 and sys.argv[1] == 'watch' and not os.path.exists(sys.argv[1]):
+            watch_mode(sys.argv[2:])
+            return
+        
         # 检查命令行参数
-        if len(sys.argv) > 1 and sys.argv[1] not in ['-u', '--usage', '-f', '--file', '-m', '--mode', '-o', '--out', '-p', '--port']:
+        if len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
             # 拖拽文件启动
             file_path = sys.argv[1]
             if os.path.exists(file_path):
@@ -1043,11 +4181,14 @@ def main():
                     print("1. IP:端口#备注 格式")
                     print("2. IP 空格 端口 格式（默认）")
                     print("3. 仅IP地址")
-                    mode_choice = input("请选择(1/2/3, 默认2): ").strip()
+                    print("4. CIDR 聚合")
+                    mode_choice = input("请选择(1/2/3/4, 默认2): ").strip()
                     if mode_choice == "1":
                         quick_mode(file_path, "ip_port_remark", is_drag_drop=False)
                     elif mode_choice == "3":
                         quick_mode(file_path, "ip_only", is_drag_drop=False)
+                    elif mode_choice == "4":
+                        quick_mode(file_path, "cidr", is_drag_drop=False)
                     else:
                         quick_mode(file_path, "ip_space_port", is_drag_drop=False)
             else:
@@ -1069,4 +4210,6 @@ def main():
         input("\n⏹️  按回车键退出...")
 
 if __name__ == "__main__":
+    # 打包为EXE后并行执行需要
+    multiprocessing.freeze_support()
     main()
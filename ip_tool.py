@@ -0,0 +1,31 @@
+"""IP处理工具的导入入口：主程序文件名含空格和点，无法直接 import，这里按路径加载为 ip_tool 模块
+
+    import ip_tool
+    for record in ip_tool.iter_records("results.csv", mode="ipspace", port=443):
+        print(record.address, record.port, record.remark)
+
+主程序以 ip_tool 的名字加载并替换本文件在 sys.modules 中的位置，import ip_tool 得到的就是主程序模块；
+并行处理的工作进程（spawn 方式启动时）据此按名字导入同一个模块，本目录也加入 sys.path 保证能找到本文件。
+
+直接运行本文件与运行主程序相同: python ip_tool.py [参数]
+"""
+import importlib.util
+import os
+import sys
+
+_MODULE_NAME = "ip_tool"
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+_MODULE_PATH = os.path.join(_MODULE_DIR, "ip_tool v2.2.py")
+
+if _MODULE_DIR not in sys.path:
+    sys.path.insert(0, _MODULE_DIR)
+
+_module = sys.modules.get(_MODULE_NAME)
+if getattr(_module, "__file__", None) != _MODULE_PATH:
+    _spec = importlib.util.spec_from_file_location(_MODULE_NAME, _MODULE_PATH)
+    _module = importlib.util.module_from_spec(_spec)
+    sys.modules[_MODULE_NAME] = _module
+    _spec.loader.exec_module(_module)
+
+if __name__ == "__main__":
+    _module.main()